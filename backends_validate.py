@@ -0,0 +1,137 @@
+import numpy as np
+from python.backends import available, futhark_call, module_name
+from python.recresid import (mrecresid, classify_pixels, PIXEL_VALID)
+from python.roc import (mhistory_roc, mhistory_roc_levels,
+                        compute_confidence_brownian)
+
+# The Futhark entries of every backend whose libraries are built (see
+# python/backends.py and the Makefile) against the numpy engines, in
+# double and single precision, on a synthetic image with nans, short and
+# empty pixels. Backends that are not built are skipped.
+
+alpha = 0.05
+conf = compute_confidence_brownian(alpha)
+
+def report(name, ok):
+  print(name, end="")
+  if ok:
+    print("\033[92m PASSED \033[0m")
+  else:
+    print("\033[91m FAILED \033[0m")
+
+def image(rng, m, N):
+  t = np.arange(N)
+  X = np.column_stack([np.ones(N), t] +
+                      [f(2*np.pi*j*t/23) for j in (1, 2)
+                                         for f in (np.sin, np.cos)])
+  ys = rng.normal(size=(m, N)) * 10 + t
+  ys[:, N//2:] += rng.normal(size=(m, 1)) * 40
+  ys[rng.random((m, N)) < 0.2] = np.nan
+  ys[:5, 6:] = np.nan
+  ys[5:10] = np.nan
+  return X, ys
+
+# Largest difference of residuals `a` from `b`, relative to the largest
+# residual of each pixel, and whether they are nan at the same places.
+def compare_residuals(a, b):
+  if not np.array_equal(np.isnan(a), np.isnan(b)):
+    return np.inf
+  rows = ~np.all(np.isnan(b), axis=1)
+  a, b = a[rows], b[rows]
+  scale = np.nanmax(np.abs(b), axis=1, keepdims=True)
+  return np.nanmax(np.abs(a - b) / scale, initial=0.0)
+
+def case_mrecresid(X, ys, backend, tol):
+  a, _, Nbar, ns = mrecresid(X, ys, backend=backend)
+  b, _, Nbar_, ns_ = mrecresid(X, ys)
+  return (Nbar == Nbar_ and np.array_equal(ns, ns_)
+          and compare_residuals(a, b) < tol)
+
+def case_mhistory_roc(X, ys, backend, tol):
+  a = mhistory_roc(X, ys, alpha, conf, backend=backend)
+  b = mhistory_roc(X, ys, alpha, conf)
+  # Starts may move where a CUSUM process is within rounding of its
+  # boundary.
+  return np.mean(a == b) >= 0.98
+
+# `mrecresid_nn_idx`, which reads the designs through indices, against
+# `mrecresid_nn` on the materialised designs, on the valid pixels.
+def case_nn_idx(X, ys, backend, tol):
+  k = X.shape[1]
+  ys = ys[classify_pixels(ys, k)[0] == PIXEL_VALID]
+  order = np.argsort(np.isnan(ys), axis=1, kind="stable")
+  pad = np.take_along_axis(np.isnan(ys), order, axis=1)
+  ys_nn = np.take_along_axis(ys, order, axis=1)
+  indss_nn = np.where(pad, -1, order).astype(np.int64)
+  Xs_nn = np.where(pad[:, :, np.newaxis], np.nan, X[order])
+  module = module_name("recresid", X.dtype)
+  a, checks_a = futhark_call(module, backend, "mrecresid_nn_idx", X,
+                             indss_nn, ys_nn)
+  b, checks_b = futhark_call(module, backend, "mrecresid_nn",
+                             Xs_nn.astype(X.dtype), ys_nn)
+  return (compare_residuals(a.T, b.T) < tol
+          and np.array_equal(checks_a, checks_b))
+
+# `mrecresid_scan`, the fits of all prefixes from a scan of the factors,
+# against `mrecresid` with `scan` on numpy, including the number of
+# prefixes fitted by `lm_factor`.
+def case_scan(X, ys, backend, tol):
+  a, fallbacks_a, _, _ = mrecresid(X, ys, backend=backend, scan=True)
+  b, fallbacks_b, _, _ = mrecresid(X, ys, scan=True)
+  return (compare_residuals(a, b) < tol
+          and np.array_equal(fallbacks_a, fallbacks_b))
+
+# Check refits per pixel of the compacted check phase of `mrecresid` and
+# of `mrecresid_grouped` against those of numpy. The absolute check of
+# the parameters can end a pixel's check phase a step apart on rounding,
+# so only most counts must be equal.
+def case_checks(X, ys, backend, tol):
+  ok = True
+  for group_masks in (False, True):
+    a, checks_a, _, _ = mrecresid(X, ys, backend=backend,
+                                  group_masks=group_masks)
+    b, checks_b, _, _ = mrecresid(X, ys, group_masks=group_masks)
+    ok = ok and (compare_residuals(a, b) < tol
+                 and np.mean(checks_a == checks_b) >= 0.95)
+  return ok
+
+# `mrecresid_csr` against the padded residuals of numpy: the offsets
+# must be those of the pixels' observations, and the values their
+# residuals.
+def case_csr(X, ys, backend, tol):
+  a, _, _, _ = mrecresid(X, ys, backend=backend, csr=True)
+  b, _, _, _ = mrecresid(X, ys, csr=True)
+  return (np.array_equal(a.offsets, b.offsets)
+          and compare_residuals(a.to_padded(), b.to_padded()) < tol)
+
+# `mhistory_roc_levels` at several levels against numpy, with the same
+# allowance as `case_mhistory_roc` per level.
+def case_levels(X, ys, backend, tol):
+  levels = [(a, compute_confidence_brownian(a)) for a in (0.01, 0.05, 0.1)]
+  a = mhistory_roc_levels(X, ys, levels, backend=backend)
+  b = mhistory_roc_levels(X, ys, levels)
+  return a.shape == b.shape and np.all(np.mean(a == b, axis=1) >= 0.98)
+
+cases = [("mrecresid", case_mrecresid),
+         ("mrecresid_csr", case_csr),
+         ("check refits", case_checks),
+         ("mrecresid_nn_idx", case_nn_idx),
+         ("mrecresid_scan", case_scan),
+         ("mhistory_roc", case_mhistory_roc),
+         ("mhistory_roc_levels", case_levels)]
+
+ok_all = True
+rng = np.random.default_rng(0)
+X, ys = image(rng, 300, 150)
+for backend in ("c", "multicore", "opencl"):
+  if not available(backend):
+    print("{}: not built, skipped".format(backend))
+    continue
+  for dtype, tol in ((np.float64, 1e-8), (np.float32, 1e-2)):
+    X_, ys_ = X.astype(dtype), ys.astype(dtype)
+    for name, case in cases:
+      ok = case(X_, ys_, backend, tol)
+      report("{} {} {}".format(backend, np.dtype(dtype).name, name), ok)
+      ok_all = ok_all and ok
+
+print(ok_all)
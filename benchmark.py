@@ -0,0 +1,239 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tracemalloc
+from glob import glob
+from timeit import default_timer as timer
+import numpy as np
+from load_dataset import load_fut_data
+from python.lm.lm import lm, mlm
+from python.recresid import recresid, mrecresid
+from python.roc import history_roc, mhistory_roc, compute_confidence_brownian
+
+# Benchmarks of the Python functions and the compiled Futhark entries on
+# synthetic images swept over (m, N, k, nan fraction) and on the data sets
+# in ./data. Results are saved as JSON so that runs on different commits
+# can be compared with --compare.
+#
+#   python benchmark.py --sweep 1000,200,8,0.25 --data
+#   python benchmark.py --compare old.json new.json
+
+alpha = 0.05
+conf = compute_confidence_brownian(alpha)
+
+# Synthetic image generated as by `main` in data/gen-data.fut, with the
+# first `k` rows of its regressor matrix (intercept, trend, harmonics).
+def gen_data(m, N, k, nan_frac, n=None, freq=12, seed=123):
+  if n is None:
+    n = N // 2
+  rng = np.random.default_rng(seed)
+  t = np.arange(1, N + 1)
+  rows = [np.ones(N), t.astype(np.float64)]
+  for i in range(2, k):
+    angle = 2*np.pi*(i // 2)*t/freq
+    rows.append(np.sin(angle) if i % 2 == 0 else np.cos(angle))
+  X = np.array(rows[:k]).T
+  breaks = rng.integers(n + 1, N, size=m)
+  before = np.arange(N) < breaks[:, np.newaxis]
+  image = np.where(before, rng.uniform(4000, 8000, (m, N)),
+                   rng.uniform(0, 5000, (m, N)))
+  image[rng.random((m, N)) < nan_frac] = np.nan
+  return X, image
+
+def _nonnan(X, y):
+  nn = ~np.isnan(y)
+  return X[nn], y[nn]
+
+# Benchmarked functions of `X` [N][k] and `image` [m][N]. Each returns
+# the number of stability checks if it knows them, else `None`.
+# Per-pixel functions are run on at most `pixels` pixels.
+def python_benchmarks(pixels):
+  def run_lm(X, image):
+    for y in image[:pixels]:
+      Xnn, ynn = _nonnan(X, y)
+      if ynn.size > 0:
+        lm(Xnn, ynn)
+  def run_mlm(X, image):
+    # Fits on the first 2k observations of every pixel.
+    m, N = image.shape
+    k = X.shape[1]
+    n = min(N, 2*k)
+    ys = np.nan_to_num(image[:, :n])
+    mlm(np.broadcast_to(X[:n], (m, n, k)).copy(), ys)
+  def run_recresid(X, image):
+    k = X.shape[1]
+    for y in image[:pixels]:
+      Xnn, ynn = _nonnan(X, y)
+      if ynn.size > k:
+        recresid(Xnn, ynn)
+  def run_mrecresid(X, image):
+    _, num_checks, _, _ = mrecresid(X, image)
+    return num_checks
+  def run_mrecresid_grouped(X, image):
+    _, num_checks, _, _ = mrecresid(X, image, group_masks=True)
+    return num_checks
+  def run_history_roc(X, image):
+    k = X.shape[1]
+    for y in image[:pixels]:
+      Xnn, ynn = _nonnan(X, y)
+      if ynn.size > k:
+        history_roc(Xnn.T, ynn, alpha, conf)
+  def run_mhistory_roc(X, image):
+    mhistory_roc(X, image, alpha, conf)
+  return [("lm", run_lm, pixels), ("mlm", run_mlm, None),
+          ("recresid", run_recresid, pixels),
+          ("mrecresid", run_mrecresid, None),
+          ("mrecresid_grouped", run_mrecresid_grouped, None),
+          ("history_roc", run_history_roc, pixels),
+          ("mhistory_roc", run_mhistory_roc, None)]
+
+# Compiled Futhark entries, if the pyopencl libraries have been built
+# (`make recresid_pyopencl.py mroc_pyopencl.py`). Results are copied back
+# so that timings include the transfer.
+def futhark_benchmarks():
+  benchmarks = []
+  try:
+    from recresid_pyopencl import recresid_pyopencl
+    recresid_fut = recresid_pyopencl()
+    def run_mrecresid(X, image):
+      retsT, num_checks, _, _ = recresid_fut.mrecresid(X, image)
+      retsT.get()
+      return num_checks.get()
+    benchmarks.append(("futhark.mrecresid", run_mrecresid, None))
+  except ImportError:
+    print("recresid_pyopencl.py not built; skipping futhark.mrecresid")
+  try:
+    from mroc_pyopencl import mroc_pyopencl
+    mroc_fut = mroc_pyopencl()
+    def run_mhistory_roc(X, image):
+      mroc_fut.mhistory_roc(alpha, conf, X, image).get()
+    def run_mhistory_roc_inline(X, image):
+      mroc_fut.mhistory_roc_inline(alpha, conf, X, image).get()
+    benchmarks += [("futhark.mhistory_roc", run_mhistory_roc, None),
+                   ("futhark.mhistory_roc_inline",
+                    run_mhistory_roc_inline, None)]
+  except ImportError:
+    print("mroc_pyopencl.py not built; skipping futhark.mhistory_roc")
+  return benchmarks
+
+# Best time of `repeat` runs, and peak traced memory of one more run.
+# Memory is host memory allocated through Python and NumPy; device
+# memory of the Futhark entries is not included.
+def measure(fun, X, image, repeat):
+  times = []
+  num_checks = None
+  for _ in range(repeat):
+    t_start = timer()
+    num_checks = fun(X, image)
+    times.append(timer() - t_start)
+  tracemalloc.start()
+  fun(X, image)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return min(times), peak, num_checks
+
+def run(datasets, benchmarks, repeat, only):
+  results = []
+  for dataset, X, image, nan_frac in datasets:
+    m, N = image.shape
+    k = X.shape[1]
+    for name, fun, pixels in benchmarks:
+      if only and name not in only:
+        continue
+      n_pixels = m if pixels is None else min(m, pixels)
+      seconds, peak, num_checks = measure(fun, X, image, repeat)
+      result = {"name": name, "dataset": dataset, "m": m, "N": N, "k": k,
+                "nan_frac": nan_frac, "pixels": n_pixels,
+                "seconds": seconds, "pixels_per_sec": n_pixels / seconds,
+                "peak_bytes": peak}
+      if num_checks is not None:
+        num_checks = np.asarray(num_checks)
+        result["checks_mean"] = float(np.mean(num_checks))
+        result["checks_max"] = int(np.max(num_checks))
+      print("{:28} {:24} {:12.1f} pixels/s {:10.1f} MiB".format(
+        name, dataset, result["pixels_per_sec"], peak / 2**20))
+      results.append(result)
+  return results
+
+def _git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                          text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def compare(old_path, new_path):
+  with open(old_path) as f:
+    old = json.load(f)
+  with open(new_path) as f:
+    new = json.load(f)
+  old_results = {(r["name"], r["dataset"]): r for r in old["results"]}
+  print("{} -> {}".format(old["commit"], new["commit"]))
+  for r in new["results"]:
+    o = old_results.get((r["name"], r["dataset"]))
+    if o is None:
+      continue
+    print("{:28} {:24} {:6.2f}x time {:6.2f}x memory".format(
+      r["name"], r["dataset"], o["seconds"] / r["seconds"],
+      r["peak_bytes"] / max(o["peak_bytes"], 1)))
+
+def _sweep(s):
+  m, N, k, nan_frac = s.split(",")
+  return int(m), int(N), int(k), float(nan_frac)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sweep", type=_sweep, nargs="*",
+                      default=[(m, N, k, f) for m in (1000, 10000)
+                               for N in (100, 400) for k in (4, 8)
+                               for f in (0.0, 0.25)],
+                      help="synthetic images as m,N,k,nan_frac")
+  parser.add_argument("--data", action="store_true",
+                      help="also run on data/d-*.in and data/real/*.in")
+  parser.add_argument("--only", type=lambda s: s.split(","), default=None,
+                      help="comma separated names of benchmarks to run")
+  parser.add_argument("--pixels", type=int, default=200,
+                      help="pixels for per-pixel functions")
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--no-futhark", action="store_true")
+  parser.add_argument("--out", default=None)
+  parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+  args = parser.parse_args()
+
+  if args.compare:
+    compare(*args.compare)
+    return
+
+  datasets = []
+  for m, N, k, nan_frac in args.sweep:
+    X, image = gen_data(m, N, k, nan_frac)
+    datasets.append(("gen-{}-{}-{}-{}".format(m, N, k, nan_frac),
+                     X, image, nan_frac))
+  if args.data:
+    for path in sorted(glob("data/d-*.in")) + sorted(glob("data/real/*.in")):
+      Xt, image = load_fut_data(path)
+      image = np.asarray(image)
+      datasets.append((os.path.basename(path).replace(".in", ""),
+                       np.ascontiguousarray(Xt.T), image,
+                       float(np.mean(np.isnan(image)))))
+
+  benchmarks = python_benchmarks(args.pixels)
+  if not args.no_futhark:
+    benchmarks += futhark_benchmarks()
+  commit = _git_commit()
+  results = run(datasets, benchmarks, args.repeat, args.only)
+  out = args.out
+  if out is None:
+    out = "bench-{}.json".format((commit or "unknown")[:10])
+  with open(out, "w") as f:
+    json.dump({"commit": commit,
+               "date": datetime.datetime.now().isoformat(),
+               "host": platform.node(), "python": platform.python_version(),
+               "numpy": np.__version__, "results": results}, f, indent=1)
+  print("Saved results to", out)
+
+if __name__ == "__main__":
+  main()
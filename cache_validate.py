@@ -0,0 +1,45 @@
+import tempfile
+import numpy as np
+from python.cache import ResultCache
+
+# Keys of `ResultCache` must depend on the values of parameters, not on
+# their Python or NumPy types: a result cached with `alpha=0.05` is found
+# with `alpha=np.float64(0.05)`, and different values get different keys.
+
+def report(name, ok):
+  print(name, end="")
+  if ok:
+    print("\033[92m PASSED \033[0m")
+  else:
+    print("\033[91m FAILED \033[0m")
+
+X = np.arange(12.0).reshape(6, 2)
+ys = np.ones((3, 6))
+ok_all = True
+with tempfile.TemporaryDirectory() as directory:
+  cache = ResultCache(directory)
+  cache.put(cache.key("history_roc", X, ys, alpha=0.05, confidence=0.9479,
+                      tol=None, k=2), np.arange(3))
+  same = [("numpy scalars", dict(alpha=np.float64(0.05),
+                                  confidence=np.float64(0.9479), tol=None,
+                                  k=np.int64(2))),
+          ("scalars from an array", dict(alpha=np.array(0.05)[()],
+                                         confidence=0.9479, tol=None,
+                                         k=np.array(2)[()]))]
+  for name, params in same:
+    hit = cache.get(cache.key("history_roc", X, ys, **params))
+    ok = hit is not None and np.array_equal(hit, np.arange(3))
+    report("same entry with {}".format(name), ok)
+    ok_all = ok_all and ok
+  other = [("another alpha", dict(alpha=0.1, confidence=0.9479, tol=None,
+                                   k=2)),
+           ("a float32 alpha", dict(alpha=np.float32(0.05),
+                                    confidence=0.9479, tol=None, k=2)),
+           ("a tolerance", dict(alpha=0.05, confidence=0.9479, tol=1e-8,
+                                k=2))]
+  for name, params in other:
+    ok = cache.get(cache.key("history_roc", X, ys, **params)) is None
+    report("other entry with {}".format(name), ok)
+    ok_all = ok_all and ok
+
+print(ok_all)
@@ -0,0 +1,33 @@
+import argparse
+from load_dataset import FutReader
+from python.store import write_tiled, DEFAULT_PIXELS
+
+# Convert data files of Futhark values, regressors `Xt` followed by the
+# image (e.g. data/real/africa.in from mkBinInput.fut), to the tiled store
+# of python/store.py. Binary images are memory-mapped, so only a block of
+# pixels is in memory at a time; textual files are read whole.
+def convert(src, dst, **kwargs):
+  with FutReader(src) as reader:
+    Xt = reader.read()
+    image = reader.read()
+    write_tiled(dst, Xt, image, **kwargs)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("src", help="data file of Futhark values")
+  parser.add_argument("dst", help="directory of the tiled store")
+  parser.add_argument("--pixels", type=int, default=DEFAULT_PIXELS,
+                      help="pixels per chunk")
+  parser.add_argument("--times", type=int, default=None,
+                      help="observations per chunk (default whole series)")
+  parser.add_argument("--compression", choices=["zlib"], default=None)
+  parser.add_argument("--level", type=int, default=6)
+  parser.add_argument("--float32", action="store_true",
+                      help="store the image in single precision")
+  args = parser.parse_args()
+  convert(args.src, args.dst, pixels=args.pixels, times=args.times,
+          compression=args.compression, level=args.level,
+          dtype="float32" if args.float32 else None)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,116 @@
+import sys
+from datetime import timedelta
+from timeit import default_timer as timer
+import numpy as np
+from load_dataset import load_fut_data
+from python.recresid import mrecresid
+from python.roc import (mhistory_roc, history_roc,
+                        compute_confidence_brownian)
+from python.pipeline import tile_size, tiles
+
+# Accuracy of single against double precision on the real world data sets:
+# recursive residuals and stable history starts computed in float32 are
+# compared with those computed in float64, and the float32 stable history
+# starts with `history_roc` per pixel in float32 on a sample of each tile.
+# The Futhark entries are used, or the Python versions if "python" is
+# given as argument. Tiles are sized from the memory budget of
+# python/pipeline.py.
+
+alpha = 0.05
+conf = compute_confidence_brownian(alpha)
+# Pixels per tile compared with `history_roc`.
+SAMPLE = 100
+
+if len(sys.argv) > 1 and sys.argv[1] == "python":
+  engine = "python"
+  def run_mrecresid(X, image):
+    rets, _, Nbar, _ = mrecresid(X, image)
+    return rets, Nbar
+  def run_mhistory_roc(X, image):
+    return mhistory_roc(X, image, alpha, conf)
+else:
+  engine = "futhark"
+  from recresid_pyopencl import recresid_pyopencl
+  from recresid_f32_pyopencl import recresid_f32_pyopencl
+  from mroc_pyopencl import mroc_pyopencl
+  from mroc_f32_pyopencl import mroc_f32_pyopencl
+  libs = {np.dtype(np.float64): (recresid_pyopencl(), mroc_pyopencl()),
+          np.dtype(np.float32): (recresid_f32_pyopencl(), mroc_f32_pyopencl())}
+  def run_mrecresid(X, image):
+    retsT, _, Nbar, _ = libs[image.dtype][0].mrecresid(X, image)
+    return retsT.get().T, Nbar
+  def run_mhistory_roc(X, image):
+    lvl, c = image.dtype.type(alpha), image.dtype.type(conf)
+    return libs[image.dtype][1].mhistory_roc(lvl, c, X, image).get()
+
+def report(name, X64, image64, X32, image32):
+  print("image size", image64.shape)
+  k = X64.shape[1]
+  m, N = image64.shape
+  print("image bytes: float64 {}, float32 {}".format(image64.nbytes,
+                                                     image32.nbytes))
+  rel_errs = []
+  starts_equal = 0
+  start_diffs = []
+  nan_diffs = 0
+  pixel_equal = 0
+  pixel_sampled = 0
+  times = {np.float64: 0.0, np.float32: 0.0}
+  chunks = tiles(m, tile_size("mhistory_roc", N, k))
+  for i, (start, stop) in enumerate(chunks):
+    c64, c32 = image64[start:stop], image32[start:stop]
+    print("~~ chunk {} ({}/{})".format(c64.shape, i+1, len(chunks)))
+    res = {}
+    for dtype, X, c in [(np.float64, X64, c64), (np.float32, X32, c32)]:
+      t_start = timer()
+      rets, Nbar = run_mrecresid(X, c)
+      starts = run_mhistory_roc(X, c)
+      times[dtype] += timer() - t_start
+      padded = np.full((c.shape[0], N-k), np.nan)
+      padded[:, :Nbar-k] = rets
+      res[dtype] = (padded, np.asarray(starts))
+    (w64, s64), (w32, s32) = res[np.float64], res[np.float32]
+    # Relative to the residual, with residuals near zero compared
+    # against the scale of the pixel's residuals instead.
+    scale = np.nanmedian(np.abs(w64), axis=1)[:, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+      rel = np.abs(w32 - w64) / np.maximum(np.abs(w64), scale)
+    rel_errs.append(rel[~np.isnan(rel)])
+    nan_diffs += np.count_nonzero(np.isnan(w32) != np.isnan(w64))
+    starts_equal += np.count_nonzero(s32 == s64)
+    start_diffs.append(np.abs(s32.astype(np.int64) - s64.astype(np.int64)))
+    sample = np.unique(np.linspace(0, c32.shape[0] - 1,
+                                   min(SAMPLE, c32.shape[0])).astype(np.int64))
+    for j in sample:
+      nn = ~np.isnan(c32[j])
+      pixel_equal += s32[j] == history_roc(X32[nn].T, c32[j, nn], alpha, conf)
+    pixel_sampled += sample.size
+
+  rel = np.concatenate(rel_errs)
+  diffs = np.concatenate(start_diffs)
+  print("== {} ({})".format(name, engine))
+  print("time float64 {}, float32 {}".format(
+    timedelta(seconds=times[np.float64]), timedelta(seconds=times[np.float32])))
+  print("Recursive residuals, relative error")
+  for q in [50, 99, 99.9]:
+    print("  {:5}th percentile {:10.5e}".format(q, np.percentile(rel, q)))
+  print("  max               {:10.5e}".format(np.max(rel)))
+  print("  nans in only one  {}".format(nan_diffs))
+  print("Stable history start")
+  print("  equal             {:.4f}% of pixels".format(100*starts_equal/m))
+  print("  max difference    {}".format(np.max(diffs)))
+  print("  mean difference   {:.4f}".format(np.mean(diffs)))
+  print("  equal to float32 history_roc per pixel {:.4f}% of {} sampled"
+        .format(100*pixel_equal/pixel_sampled, pixel_sampled))
+
+datasets = [
+  ("data/real/sahara.in", "sahara"),
+  ("data/real/peru.in", "peru"),
+  ("data/real/africa.in", "africa"),
+]
+for (path, name) in datasets:
+  print("\n== Comparing float32 with float64 on {} data set ({})."
+        .format(name, path))
+  Xt64, image64 = load_fut_data(path)
+  Xt32, image32 = load_fut_data(path, np_dtype=np.float32)
+  report(name, Xt64.T, image64, Xt32.T, image32)
@@ -1,9 +1,269 @@
+import re
+import struct
+import warnings
 import numpy as np
 
-def load_fut_data(filename, np_dtype=np.float64, f_dtype="f64"):
-  parse = lambda line: line.replace(f_dtype,"").replace(".nan", "float('nan')")
-  with open(filename, "r") as f:
-    Xt = np.array(eval(parse(f.readline())), dtype=np_dtype)
-    image = np.array(eval(parse(f.readline())), dtype=np_dtype)
-  return (Xt, image)
+# Reader for files of Futhark values in the textual or binary data format.
+# Values are read one at a time while streaming through the file; nothing
+# is `eval`'ed. Binary arrays are memory-mapped rather than read, so that
+# slicing them only touches the pages that are used.
+
+_BINARY_TYPES = {
+  b"  i8": np.int8, b" i16": np.int16, b" i32": np.int32, b" i64": np.int64,
+  b"  u8": np.uint8, b" u16": np.uint16, b" u32": np.uint32,
+  b" u64": np.uint64, b" f16": np.float16, b" f32": np.float32,
+  b" f64": np.float64, b"bool": np.bool_,
+}
+
+_SUFFIX_TYPES = {t.strip(): d for t, d in _BINARY_TYPES.items()}
+
+_TOKEN = re.compile(rb"""
+    (?P<comment>--[^\n]*)
+  | (?P<open>\[)
+  | (?P<close>\])
+  | (?P<sep>,)
+  | (?P<empty>empty\((?P<eshape>(?:\[\d+\])+)(?P<etype>\w+)\))
+  | (?P<num>(?P<sign>[-+]?)
+             (?:f(?:16|32|64)\.(?P<special>nan|inf)
+               |(?P<lit>\d[\d_]*(?:\.\d*)?(?:[eE][-+]?\d+)?))
+             (?P<suffix>[iuf](?:8|16|32|64))?)
+  | (?P<bool>true|false)
+  | (?P<bad>\S)
+""", re.X)
+
+_DELIMITERS = [b" ", b"\n", b"\t", b"\r", b",", b"[", b"]"]
+
+# Number of scalars converted to an array at a time.
+_BLOCK = 1 << 16
+
+class FutReader:
+  def __init__(self, filename, chunk_size=1 << 20):
+    self.filename = filename
+    self.chunk_size = chunk_size
+    self.f = open(filename, "rb")
+    # Position of the first byte after the last value read.
+    self.pos = 0
+
+  def close(self):
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __iter__(self):
+    while True:
+      value = self.read()
+      if value is None:
+        return
+      yield value
+
+  # Read the next value, or return `None` at the end of the file.
+  # If `rows` is a `(start, stop)` pair only those rows of the value
+  # are kept. Reading a textual value then stops after the last row,
+  # so no further values can be read.
+  def read(self, rows=None):
+    if not self._skip_space():
+      return None
+    self.f.seek(self.pos)
+    if self.f.read(1) == b"b":
+      return self._read_binary(rows)
+    return self._read_text(rows, rows is not None)
 
+  # Skip the next value without keeping any of it.
+  def skip(self):
+    if not self._skip_space():
+      return
+    self.f.seek(self.pos)
+    if self.f.read(1) == b"b":
+      self._read_binary((0, 0))
+    else:
+      self._read_text((0, 0), False)
+
+  # Skip whitespace and comments, returning whether a value follows.
+  def _skip_space(self):
+    for kind, m, end in self._tokens(self.pos):
+      if kind != "comment":
+        self.pos = end - len(m.group())
+        return True
+    return False
+
+  def _read_binary(self, rows):
+    version, rank = struct.unpack("<Bb", self.f.read(2))
+    if version != 2:
+      raise ValueError("Unsupported binary data format version {} in {}"
+                       .format(version, self.filename))
+    tname = self.f.read(4)
+    if tname not in _BINARY_TYPES:
+      raise ValueError("Unknown binary type {!r} in {}"
+                       .format(tname, self.filename))
+    dtype = np.dtype(_BINARY_TYPES[tname])
+    shape = struct.unpack("<{}Q".format(rank), self.f.read(8*rank))
+    offset = self.pos + 7 + 8*rank
+    size = int(np.prod(shape, dtype=np.int64))
+    self.pos = offset + size*dtype.itemsize
+    if size == 0 or rank == 0:
+      self.f.seek(offset)
+      data = np.frombuffer(self.f.read(size*dtype.itemsize), dtype=dtype)
+      value = data.reshape(shape)
+    else:
+      value = np.memmap(self.filename, dtype=dtype, mode="r",
+                        offset=offset, shape=shape)
+    if rows is not None:
+      value = value[rows[0]:rows[1]]
+    return value
+
+  # Tokens from byte `pos` onwards, read in chunks. Yields the kind
+  # of token, its match and the position of the byte following it.
+  # Characters that cannot start a token are yielded as "bad".
+  def _tokens(self, pos):
+    self.f.seek(pos)
+    buf = b""
+    base = pos
+    while True:
+      chunk = self.f.read(self.chunk_size)
+      buf += chunk
+      cut = len(buf)
+      if chunk:
+        # Only tokenise up to the last delimiter, as the rest may be
+        # the beginning of a token continuing in the next chunk.
+        cut = max(buf.rfind(c) for c in _DELIMITERS) + 1
+        if cut == 0:
+          continue
+        line = buf.rfind(b"\n", 0, cut)
+        comment = buf.find(b"--", line + 1, cut)
+        if comment != -1:
+          cut = comment
+      for m in _TOKEN.finditer(buf, 0, cut):
+        yield m.lastgroup, m, base + m.end()
+      buf = buf[cut:]
+      base += cut
+      if not chunk:
+        return
+
+  def _read_text(self, rows, stop_early):
+    start, stop = rows if rows is not None else (0, None)
+    shape = []
+    counts = []
+    depth = 0
+    literals = []
+    blocks = []
+    dtype = None
+    row = 0
+    for kind, m, end in self._tokens(self.pos):
+      if kind in ("comment", "sep"):
+        continue
+      if kind == "bad":
+        raise ValueError("Unexpected {!r} at byte {} of {}"
+                         .format(m.group(), end - 1, self.filename))
+      if kind == "open":
+        if depth > 0:
+          counts[depth-1] += 1
+        depth += 1
+        if len(counts) < depth:
+          counts.append(0)
+        counts[depth-1] = 0
+        continue
+      if kind == "close":
+        if len(shape) < depth:
+          shape.extend([None] * (depth - len(shape)))
+        if shape[depth-1] is None:
+          shape[depth-1] = counts[depth-1]
+        depth -= 1
+        if depth == 1:
+          row += 1
+        if depth == 0:
+          break
+        if stop_early and depth == 1 and row >= stop:
+          break
+        continue
+      if kind == "empty":
+        if depth > 0:
+          raise ValueError("Nested empty arrays are not supported in {}"
+                           .format(self.filename))
+        eshape = [int(d) for d in re.findall(rb"\d+", m.group("eshape"))]
+        self.pos = end
+        return np.empty(eshape, dtype=_SUFFIX_TYPES[m.group("etype")])
+      # Scalar.
+      if depth > 0:
+        counts[depth-1] += 1
+      if dtype is None:
+        dtype = _literal_type(m)
+      if depth == 1:
+        index = counts[0] - 1
+      else:
+        index = row
+      if depth == 0 or (index >= start and (stop is None or index < stop)):
+        literals.append(_literal(m))
+        if len(literals) >= _BLOCK:
+          blocks.append(_convert(literals, dtype))
+          literals = []
+      if depth == 0:
+        break
+      if stop_early and depth == 1 and counts[0] >= stop:
+        break
+    else:
+      if depth > 0:
+        raise ValueError("Unterminated array in {}".format(self.filename))
+    self.pos = end
+    blocks.append(_convert(literals, dtype or np.float64))
+    data = np.concatenate(blocks)
+    if not counts:
+      return data.reshape(())
+    # Only the kept rows are returned.
+    total = row if len(counts) > 1 else counts[0]
+    kept = max(0, min(total, total if stop is None else stop) - start)
+    return data.reshape([kept] + shape[1:len(counts)])
+
+def _literal_type(m):
+  if m.lastgroup == "bool":
+    return np.bool_
+  suffix = m.group("suffix")
+  if suffix is not None:
+    return _SUFFIX_TYPES[suffix]
+  if m.group("special") is not None or not m.group("lit").isdigit():
+    return np.float64
+  return np.int32
+
+def _literal(m):
+  if m.lastgroup == "bool":
+    return b"1" if m.group() == b"true" else b"0"
+  if m.group("special") is not None:
+    return m.group("sign") + m.group("special")
+  return m.group("sign") + m.group("lit").replace(b"_", b"")
+
+def _convert(literals, dtype):
+  if dtype is np.bool_:
+    return np.array(literals, dtype=np.bytes_).astype(np.int8).astype(dtype)
+  return np.array(literals, dtype=np.bytes_).astype(dtype)
+
+# All values of a Futhark data file.
+# Binary arrays are memory-mapped.
+def load_fut_values(filename):
+  with FutReader(filename) as reader:
+    return list(reader)
+
+# Rows `start` to `stop` of value `index` of a Futhark data file, e.g.
+# a range of pixels of the image in a data set. Earlier values are
+# skipped, and a textual file is only read up to the last row needed.
+def load_fut_rows(filename, start, stop, index=1, np_dtype=np.float64):
+  with FutReader(filename) as reader:
+    for _ in range(index):
+      reader.skip()
+    return np.asarray(reader.read(rows=(start, stop)), dtype=np_dtype)
+
+# The regressor matrix, transposed, and the image of a data set.
+# `f_dtype`, the suffix of the literals in the file, was needed by the
+# earlier `eval` based reader; the types now come from the file, and it
+# is only accepted, with a warning, for existing callers.
+def load_fut_data(filename, np_dtype=np.float64, f_dtype=None):
+  if f_dtype is not None:
+    warnings.warn("load_fut_data: f_dtype is deprecated and ignored, the "
+                  "types are read from the file", DeprecationWarning,
+                  stacklevel=2)
+  with FutReader(filename) as reader:
+    Xt = np.asarray(reader.read(), dtype=np_dtype)
+    image = np.asarray(reader.read(), dtype=np_dtype)
+  return (Xt, image)
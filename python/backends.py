@@ -0,0 +1,74 @@
+import importlib
+import numpy as np
+
+# Engines for the image-level functions `mrecresid` and `mhistory_roc`,
+# chosen with their `backend=` argument:
+#   "numpy"      the NumPy implementation, always available,
+#   "c"          Futhark compiled with `futhark c --library`,
+#   "multicore"  Futhark compiled with `futhark multicore --library`,
+#   "opencl"     Futhark compiled with `futhark pyopencl --library`,
+#   "auto"       the first available of opencl, multicore, c and numpy.
+# The c and multicore libraries are loaded through futhark-ffi (cffi);
+# all libraries are built by the Makefile in the repository root, e.g.
+# `make recresid_multicore.ffi mroc_multicore.ffi`, which must be on the
+# Python path.
+
+BACKENDS = ("numpy", "c", "multicore", "opencl")
+_AUTO_ORDER = ("opencl", "multicore", "c", "numpy")
+
+# Loaded libraries and their converters of results to NumPy,
+# by module and backend.
+_libs = {}
+
+# The Futhark library of `module` compiled with `backend`, loaded once,
+# and its converter of results to NumPy. python/pipeline.py calls its
+# entries itself, to copy tiles to and from the device on its threads.
+def load_library(module, backend):
+  key = (module, backend)
+  if key not in _libs:
+    if backend == "opencl":
+      name = module + "_pyopencl"
+      lib = getattr(importlib.import_module(name), name)()
+      def convert(x):
+        return x.get() if hasattr(x, "get") else x
+    else:
+      from futhark_ffi import Futhark
+      lib = Futhark(importlib.import_module("_{}_{}".format(module, backend)))
+      def convert(x):
+        if isinstance(x, (bool, int, float, np.generic)):
+          return x
+        return lib.from_futhark(x)
+    _libs[key] = (lib, convert)
+  return _libs[key]
+
+# Whether the libraries of `backend` can be loaded.
+def available(backend):
+  if backend == "numpy":
+    return True
+  try:
+    load_library("recresid", backend)
+    load_library("mroc", backend)
+  except Exception:
+    return False
+  return True
+
+def resolve(backend):
+  if backend == "auto":
+    return next(b for b in _AUTO_ORDER if available(b))
+  if backend not in BACKENDS:
+    raise ValueError("Unknown backend {!r}, expected one of {}"
+                     .format(backend, ", ".join(BACKENDS + ("auto",))))
+  return backend
+
+# Futhark module holding the entries for `dtype`.
+def module_name(module, dtype):
+  return module + "_f32" if dtype == np.float32 else module
+
+# Call `entry` of Futhark `module` compiled with `backend`, returning
+# results as NumPy arrays and scalars.
+def futhark_call(module, backend, entry, *args):
+  lib, convert = load_library(module, backend)
+  res = getattr(lib, entry)(*args)
+  if isinstance(res, tuple):
+    return tuple(convert(r) for r in res)
+  return convert(res)
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+# Bytes hashed for the parameter value `v`: numbers by value whatever
+# their Python or NumPy type, so that e.g. `0.05` and `np.float64(0.05)`
+# give the same key, sequences element by element and arrays by their
+# type, shape and bytes.
+def _param_bytes(v):
+  if v is None or isinstance(v, str):
+    return repr(v).encode()
+  if isinstance(v, (bool, np.bool_)):
+    return repr(bool(v)).encode()
+  if isinstance(v, (int, np.integer)):
+    return repr(int(v)).encode()
+  if isinstance(v, (float, np.floating)):
+    return repr(float(v)).encode()
+  if isinstance(v, (list, tuple)):
+    return b"(" + b",".join(_param_bytes(x) for x in v) + b")"
+  a = np.ascontiguousarray(v)
+  return "{}{}".format(a.dtype.str, a.shape).encode() + a.tobytes()
+
+# On-disk cache of result arrays, addressed by a hash of everything the
+# result depends on: the bytes, shapes and types of the input arrays and
+# the parameters of the computation. Entries are written atomically and
+# the least recently used ones are evicted once the cache grows beyond
+# `max_bytes`.
+class ResultCache:
+  def __init__(self, directory=".cache/results", max_bytes=4 << 30):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    os.makedirs(directory, exist_ok=True)
+
+  # Key of the result of computation `name` on `arrays` with `params`.
+  def key(self, name, *arrays, **params):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(name.encode())
+    for a in arrays:
+      a = np.ascontiguousarray(a)
+      h.update("{}{}".format(a.dtype.str, a.shape).encode())
+      h.update(memoryview(a).cast("B"))
+    for p in sorted(params):
+      h.update("{}=".format(p).encode())
+      h.update(_param_bytes(params[p]))
+      h.update(b";")
+    return "{}-{}".format(name, h.hexdigest())
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + ".npy")
+
+  # The cached result for `key`, or `None`.
+  def get(self, key):
+    path = self._path(key)
+    try:
+      with open(path, "rb") as f:
+        value = np.load(f)
+    except FileNotFoundError:
+      return None
+    # Mark as recently used.
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      pass
+    return value
+
+  def put(self, key, value):
+    fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        np.save(f, value)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp, self._path(key))
+    except BaseException:
+      os.unlink(tmp)
+      raise
+    self.evict()
+
+  # Remove least recently used entries until the cache fits.
+  def evict(self):
+    entries = []
+    for e in os.scandir(self.directory):
+      if e.name.endswith(".npy"):
+        try:
+          st = e.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+
+  # Result of `compute()` for computation `name` on `arrays` with
+  # `params`, computed only if it is not cached.
+  def get_or_compute(self, compute, name, *arrays, **params):
+    key = self.key(name, *arrays, **params)
+    value = self.get(key)
+    if value is None:
+      value = compute()
+      self.put(key, value)
+    return value
@@ -0,0 +1,100 @@
+import os
+from concurrent.futures import (ProcessPoolExecutor, CancelledError,
+                                FIRST_COMPLETED, wait)
+from multiprocessing import Event
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+from .roc import history_roc
+
+# Arrays shared with the worker processes, attached by `_init_worker`.
+_shared = {}
+
+def _to_shared(arr):
+  shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+  shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+  shared[:] = arr
+  return shm, shared
+
+def _attach(name, shape, dtype):
+  shm = SharedMemory(name=name)
+  return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _init_worker(X_spec, image_spec, out_spec, alpha, confidence, stop):
+  _shared["X"] = _attach(*X_spec)
+  _shared["image"] = _attach(*image_spec)
+  _shared["out"] = _attach(*out_spec)
+  _shared["args"] = (alpha, confidence)
+  _shared["stop"] = stop
+
+# Stable history start of pixels `start` to `stop` of the shared image,
+# written to the shared output. Returns the number of pixels processed,
+# which is less than requested if the run was cancelled.
+def _history_roc_tile(start, stop):
+  _, X = _shared["X"]
+  _, image = _shared["image"]
+  _, out = _shared["out"]
+  alpha, confidence = _shared["args"]
+  k = X.shape[1]
+  for i in range(start, stop):
+    if _shared["stop"].is_set():
+      return i - start
+    y = image[i]
+    nn = ~np.isnan(y)
+    # Pixels with too few observations have no stable history.
+    if np.count_nonzero(nn) <= k:
+      out[i] = 0
+    else:
+      out[i] = history_roc(X[nn].T, y[nn], alpha, confidence)
+  return stop - start
+
+# Stable history start of every pixel in `image` [m][N], with regressors
+# `X` [N][k] shared by all pixels; nans in `image` are missing values.
+#
+# The image is split into tiles of `tile_size` pixels that are processed by
+# a pool of `workers` processes. `X`, the image and the result are placed
+# in shared memory, so only tile bounds are sent to the workers.
+# `progress(done, m)` is called as tiles complete. Setting the event
+# `cancel` stops all workers and raises `CancelledError`.
+def history_roc_image(X, image, alpha, confidence, workers=None,
+                      tile_size=None, progress=None, cancel=None):
+  m, N = image.shape
+  assert(X.shape[0] == N)
+  if workers is None:
+    workers = os.cpu_count()
+  if tile_size is None:
+    # A few tiles per worker to balance uneven pixel cost.
+    tile_size = max(1, -(-m // (4*workers)))
+
+  stop = Event()
+  X_shm, X_sh = _to_shared(np.ascontiguousarray(X, dtype=np.float64))
+  image_shm, image_sh = _to_shared(np.ascontiguousarray(image,
+                                                        dtype=np.float64))
+  out_shm, out = _to_shared(np.zeros(m, dtype=np.int64))
+  specs = [(shm.name, a.shape, a.dtype) for shm, a in
+           [(X_shm, X_sh), (image_shm, image_sh), (out_shm, out)]]
+  try:
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(*specs, alpha, confidence,
+                                       stop)) as pool:
+      pending = {pool.submit(_history_roc_tile, i, min(i + tile_size, m))
+                 for i in range(0, m, tile_size)}
+      done = 0
+      while pending:
+        finished, pending = wait(pending, timeout=0.1,
+                                 return_when=FIRST_COMPLETED)
+        for f in finished:
+          done += f.result()
+        if finished and progress is not None:
+          progress(done, m)
+        if cancel is not None and cancel.is_set():
+          stop.set()
+          for f in pending:
+            f.cancel()
+          raise CancelledError()
+    return out.copy()
+  finally:
+    for shm in (X_shm, image_shm, out_shm):
+      shm.close()
+      shm.unlink()
@@ -0,0 +1,76 @@
+import time
+from collections import defaultdict
+import numpy as np
+
+# Opt-in instrumentation of `recresid`, `mrecresid` and the history_roc
+# functions, which take a `Profile` as `profile=`; without one nothing is
+# recorded. A profile may be passed to several calls, e.g. one per tile,
+# in which case pixels are numbered consecutively across the calls.
+#
+# Stages are
+#   init       initial fits on the first `k` observations,
+#   check      iterations of the recursion while any pixel is checked
+#              for numerical stability, including the refits,
+#   unchecked  the remaining iterations,
+#   scan       residuals computed in parallel over time (`scan=True`),
+#   cusum      standardised CUSUM processes,
+#   sctest     structural change tests,
+#   boundary   boundaries and the search for the first crossing.
+class Profile:
+  def __init__(self):
+    self.times = defaultdict(float)
+    # Check refits from updated factorisations and those that fell
+    # back to a full `lm` fit.
+    self.refits = 0
+    self.full_refits = 0
+    self.pixels = 0
+    self._checks = []
+    self._rank_deficient = []
+
+  def start(self):
+    return time.perf_counter()
+
+  # Add the time since `t` from `start` to `stage`.
+  def stop(self, stage, t):
+    self.times[stage] += time.perf_counter() - t
+
+  # Record the number of check iterations of each of the pixels of a
+  # call, which numbers them.
+  def add_pixels(self, checks):
+    self._checks.append(np.atleast_1d(np.asarray(checks, dtype=np.int64)))
+    self.pixels += self._checks[-1].size
+
+  # Record fits of rank below `k` for pixels `pixels` of the current call
+  # (not yet added) on observations up to `step`, counted among each
+  # pixel's non-nan observations.
+  def add_rank_deficient(self, pixels, step, ranks):
+    pixels = self.pixels + np.atleast_1d(pixels)
+    self._rank_deficient.append(
+      np.stack([pixels, np.full(pixels.size, step),
+                np.atleast_1d(ranks)], axis=1).astype(np.int64))
+
+  @property
+  def checks(self):
+    return np.concatenate(self._checks or [np.zeros(0, dtype=np.int64)])
+
+  # Pixels with the most check iterations, most first.
+  def slowest_pixels(self, n=10):
+    checks = self.checks
+    order = np.argsort(-checks, kind="stable")[:n]
+    return order, checks[order]
+
+  def report(self):
+    events = np.concatenate(self._rank_deficient
+                            or [np.zeros((0, 3), dtype=np.int64)])
+    checks = self.checks
+    return {
+      "times": dict(self.times),
+      "pixels": self.pixels,
+      "refits": self.refits,
+      "full_refits": self.full_refits,
+      "checks": checks,
+      "checks_total": int(np.sum(checks)),
+      "checks_max": int(np.max(checks, initial=0)),
+      "rank_deficient": {"pixel": events[:, 0], "step": events[:, 1],
+                         "rank": events[:, 2]},
+    }
@@ -87,21 +87,27 @@
 #
 import numpy as np
 
-def dqrdc2(x, ldx, n, p, tol=1e-7):
-  qraux = np.zeros(p)
-  work = np.zeros((p,2))
+# Tolerance of the rank decisions for `dtype`: R's 1e-7 in double
+# precision, scaled with the square root of the machine epsilon
+# otherwise, as columns are compared by their norms.
+def default_qr_tol(dtype=np.float64):
+  eps = np.finfo(dtype).eps
+  return 1e-7 * float(np.sqrt(eps / np.finfo(np.float64).eps))
+
+def dqrdc2(x, ldx, n, p, tol=None):
+  if tol is None:
+    tol = default_qr_tol(x.dtype)
+  qraux = np.zeros(p, dtype=x.dtype)
+  work = np.zeros((p,2), dtype=x.dtype)
   jpvt = np.arange(p)
 #
 #
 # compute the norms of the columns of x.
 #
   if n > 0:
-    for j in range(0,p):
-      qraux[j] = np.linalg.norm(x[:,j], 2)
-      work[j,0] = qraux[j]
-      work[j,1] = qraux[j]
-      if work[j,1] == 0.0:
-        work[j,1] = 1.0
+    qraux[:] = np.linalg.norm(x, 2, axis=0)
+    work[:,0] = qraux
+    work[:,1] = np.where(qraux == 0.0, 1.0, qraux)
 #
 # perform the householder reduction of x.
 #
@@ -118,24 +124,12 @@ def dqrdc2(x, ldx, n, p, tol=1e-7):
 #
   for l in range(0, lup):
     while l+1 < k and qraux[l] < work[l,1]*tol:
-      lp1 = l+1
-      for i in range(n):
-        t = x[i,l]
-        for j in range(lp1, p):
-          x[i, j-1] = x[i,j]
-        x[i,p-1] = t
-      i = jpvt[l]
-      t = qraux[l]
-      tt = work[l,0]
-      ttt = work[l,1]
-      for j in range(lp1, p):
-        jpvt[j-1] = jpvt[j]
-        qraux[j-1] = qraux[j]
-        work[j-1,:] = work[j,:]
-      jpvt[p-1] = i
-      qraux[p-1] = t
-      work[p-1,0] = tt
-      work[p-1,1] = ttt
+      # rotate columns l..p-1 one step to the left, moving
+      # column l (and its bookkeeping) to the right-hand edge.
+      x[:,l:] = np.roll(x[:,l:], -1, axis=1)
+      jpvt[l:] = np.roll(jpvt[l:], -1)
+      qraux[l:] = np.roll(qraux[l:], -1)
+      work[l:,:] = np.roll(work[l:,:], -1, axis=0)
       k = k -1
 #
 #     compute the householder transformation for column l.
@@ -150,17 +144,11 @@ def dqrdc2(x, ldx, n, p, tol=1e-7):
         #       apply the transformation to the remaining columns,
         #       updating the norms.
         #
-        for j in range(l+1, p):
-          t = -1*np.dot(x[l:,l], x[l:,j])/x[l,l]
-          # print("Trace at dqrdc2.py.:..:..-..:", l, j, x[l:,j])
-          # print("Trace at dqrdc2.py.:..:..-..:", l, j, x[l:,l])
-          # print("Trace at dqrdc2.py.:..:..-..:", l, j, t)
-          x[l:,j] = x[l:,j] + t*x[l:,l]
-          # print("Trace at dqrdc2.py.:..:..-..:", l, j, x[l:,j])
-          if qraux[j] != 0.0:
-            tt = 1.0 - (abs(x[l,j])/qraux[j])**2
-            tt = max(tt, 0.0)
-            t = tt
+        t = -1*(x[l:,l] @ x[l:,l+1:])/x[l,l]
+        x[l:,l+1:] = x[l:,l+1:] + np.outer(x[l:,l], t)
+        js = l+1 + np.flatnonzero(qraux[l+1:] != 0.0)
+        tt = 1.0 - (np.abs(x[l,js])/qraux[js])**2
+        t = np.maximum(tt, 0.0)
         #
         # modified 9/99 by BDR. Re-compute norms if there is large reduction
         # The tolerance here is on the squared norm
@@ -169,11 +157,11 @@ def dqrdc2(x, ldx, n, p, tol=1e-7):
         #
         #           tt = 1.0 + 0.05*tt*(qraux[j]/work[j,0])**2
         #           if tt != 1.0:
-            if abs(t) >= 1e-6:
-              qraux[j] = qraux[j]*np.sqrt(t)
-            else:
-              qraux[j] = np.linalg.norm(x[l+1:,j], 2)
-              work[j,0] = qraux[j]
+        big = np.abs(t) >= 1e-6
+        qraux[js[big]] = qraux[js[big]]*np.sqrt(t[big])
+        small = js[~big]
+        qraux[small] = np.linalg.norm(x[l+1:,small], 2, axis=0)
+        work[small,0] = qraux[small]
         #
         #     save the transformation.
         #
@@ -183,6 +171,64 @@ def dqrdc2(x, ldx, n, p, tol=1e-7):
   k = min(k-1, n)
   return x, k, qraux, jpvt
 
+# Stacked `dqrdc2` for `m` matrices of the same shape, `x` is [m][n][p].
+# Pivoting and rank decisions are made independently for each matrix;
+# outputs gain a leading dimension of size `m`.
+def mdqrdc2(x, n, p, tol=None):
+  if tol is None:
+    tol = default_qr_tol(x.dtype)
+  m = x.shape[0]
+  qraux = np.zeros((m,p), dtype=x.dtype)
+  work = np.zeros((m,p,2), dtype=x.dtype)
+  jpvt = np.tile(np.arange(p), (m,1))
+  k = np.full(m, p + 1)
+  if n > 0:
+    qraux[:] = np.linalg.norm(x, 2, axis=1)
+    work[:,:,0] = qraux
+    work[:,:,1] = np.where(qraux == 0.0, 1.0, qraux)
+  lup = min(n,p)
+  for l in range(0, lup):
+    while True:
+      move = (l+1 < k) & (qraux[:,l] < work[:,l,1]*tol)
+      if not move.any():
+        break
+      x[move,:,l:] = np.roll(x[move,:,l:], -1, axis=2)
+      jpvt[move,l:] = np.roll(jpvt[move,l:], -1, axis=1)
+      qraux[move,l:] = np.roll(qraux[move,l:], -1, axis=1)
+      work[move,l:,:] = np.roll(work[move,l:,:], -1, axis=1)
+      k[move] = k[move] - 1
+    if l+1 != n:
+      nrmxl = np.linalg.norm(x[:,l:,l], 2, axis=1)
+      # Only matrices with a non-zero column are transformed.
+      hs = np.flatnonzero(nrmxl != 0.0)
+      xh = x[hs]
+      nrmxl = nrmxl[hs]
+      xll = xh[:,l,l]
+      nrmxl = np.where(xll != 0.0, np.sign(xll) * np.abs(nrmxl), nrmxl)
+      xh[:,l:,l] = xh[:,l:,l] / nrmxl[:,np.newaxis]
+      xh[:,l,l] = 1.0 + xh[:,l,l]
+      v = xh[:,l:,l]
+      t = -1*np.einsum("hi,hij->hj", v, xh[:,l:,l+1:])/xh[:,l,l,np.newaxis]
+      xh[:,l:,l+1:] = xh[:,l:,l+1:] + v[:,:,np.newaxis]*t[:,np.newaxis,:]
+      q = qraux[hs,l+1:]
+      nz = q != 0.0
+      with np.errstate(divide="ignore", invalid="ignore"):
+        tt = 1.0 - (np.abs(xh[:,l,l+1:])/q)**2
+      t = np.maximum(tt, 0.0)
+      big = nz & (np.abs(t) >= 1e-6)
+      small = nz & ~big
+      q = np.where(big, q*np.sqrt(np.where(big, t, 0.0)), q)
+      norms = np.linalg.norm(xh[:,l+1:,l+1:], 2, axis=1)
+      q = np.where(small, norms, q)
+      work[hs,l+1:,0] = np.where(small, norms, work[hs,l+1:,0])
+      qraux[hs,l+1:] = q
+      qraux[hs,l] = xh[:,l,l]
+      xh[:,l,l] = -1*nrmxl
+      x[hs] = xh
+
+  k = np.minimum(k-1, n)
+  return x, k, qraux, jpvt
+
 if __name__ == "__main__":
   X = np.array([[-1.88817327e-05, 4.45881295e-05], [2.95671876e-04, -6.98212188e-04]])
   X = np.array(
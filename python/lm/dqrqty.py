@@ -1,11 +1,12 @@
 import numpy as np
 from scipy import linalg
 
-def dqrqty(a, qraux, k, y):
+def dqrqty(a, qraux, k, y, qty=None):
   n, _ = a.shape
   ju = min(k, n-1)
 
-  qty = np.zeros(n)
+  if qty is None:
+    qty = np.zeros(n, dtype=a.dtype)
   qty[0:n] = y[0:n]
   for j in range ( 0, ju ):
     if ( qraux[j] != 0.0 ):
@@ -13,11 +14,32 @@ def dqrqty(a, qraux, k, y):
       ajj = a[j,j]
       a[j,j] = qraux[j]
       t = - (np.sum(a[j:n,j] * qty[j:n]))/a[j,j]
-      qty[j:n] = qty[j:n] + t*a[j:n,j]
+      qty[j:n] += t*a[j:n,j]
       # revert back to original diagonal
       a[j,j] = ajj
   return qty
 
+# Stacked `dqrqty` for [m][n][p] factorisations from `mdqrdc2`,
+# with per-matrix ranks `k` and responses `y` of shape [m][n].
+# With `gids` there are several responses per factorisation: `y` is
+# [len(gids)][n] and response `i` is rotated by factorisation `gids[i]`.
+def mdqrqty(a, qraux, k, y, gids=None):
+  _, n, _ = a.shape
+  if gids is None:
+    gids = np.arange(a.shape[0])
+  ju = np.minimum(k[gids], n-1)
+
+  qty = y.copy()
+  for j in range ( 0, np.max(ju, initial=0) ):
+    act = np.flatnonzero((j < ju) & (qraux[gids,j] != 0.0))
+    g = gids[act]
+    # put qraux on diagonal
+    v = a[g,j:n,j]
+    v[:,0] = qraux[g,j]
+    t = - (np.sum(v * qty[act,j:n], axis=1))/v[:,0]
+    qty[act,j:n] = qty[act,j:n] + t[:,np.newaxis]*v
+  return qty
+
 # TODO --- implement "qty" in python;
 #          check against dqrsl example/this loop code
 #      --- implement "qty" in futhark; check against python qty
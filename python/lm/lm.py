@@ -1,23 +1,69 @@
 import numpy as np
 from scipy.linalg import cho_solve, solve_triangular
-from .dqrdc2 import dqrdc2
-from .dqrqty import dqrqty
+from .dqrdc2 import dqrdc2, mdqrdc2
+from .dqrqty import dqrqty, mdqrqty
 
-def lm(X, y):
+# Solvers of `lm`:
+#   "qr"    pivoted QR factorisation by dqrdc2, as R's `lm.fit`,
+#   "chol"  normal equations by Cholesky factorisation when X'X is well
+#           conditioned, else "qr"; see python/lm/normal.py.
+SOLVERS = ("qr", "chol")
+
+def check_solver(solver):
+  if solver not in SOLVERS:
+    raise ValueError("Unknown solver {!r}, expected one of {}"
+                     .format(solver, ", ".join(SOLVERS)))
+
+# Preallocated buffers for repeated `lm` fits of designs with at most
+# `n` rows and `p` columns, so that fits can be done without allocating
+# matrices. Results returned by `lm` alias these buffers and are only
+# valid until the workspace is used again.
+class LmWorkspace:
+  def __init__(self, n, p, dtype=np.float64):
+    self.A = np.empty((n, p), dtype=dtype)
+    self.qty = np.empty(n, dtype=dtype)
+    self.r = np.empty((p, p), dtype=dtype)
+    self.lower = np.tri(p, k=-1, dtype=bool)
+    self.identity = np.identity(p, dtype=dtype)
+    self.scratch = np.empty((p, p), dtype=dtype)
+    self.b = np.empty(p, dtype=dtype)
+
+# With solver "chol" a well conditioned fit returns the Cholesky factor
+# of X'X, which equals r up to signs, and no `qraux`.
+def lm(X, y, ws=None, solver="qr"):
+  check_solver(solver)
   n,p  = X.shape
   y = y.reshape(n)
-  A, rank, qraux, jpvt = dqrdc2(X.copy(), n, n, p)
-  r = np.triu(A)[:p, :p]
+  if solver == "chol" and n >= p:
+    # python/lm/normal.py builds on the stacked solves below.
+    from .normal import lm_normal
+    fit = lm_normal(X.T @ X, X.T @ y)
+    if fit is not None:
+      b, cov_params, c = fit
+      return b, cov_params, p, c, None
+  if ws is None:
+    ws = LmWorkspace(n, p, X.dtype)
+  A = ws.A[:n]
+  A[:] = X
+  A, rank, qraux, jpvt = dqrdc2(A, n, n, p)
+  r = ws.r[:min(n, p)]
+  r[:] = A[:p, :p]
+  np.copyto(r, 0.0, where=ws.lower[:min(n, p)])
   # Inverting r with cholesky gives (X.T X)^{-1}
-  cov_params = cho_solve((r[:rank, :rank], False), np.identity(rank))
+  cov_params = cho_solve((r[:rank, :rank], False), ws.identity[:rank, :rank])
   # compute parameters
-  qty = dqrqty(A, qraux, rank, y.copy())
+  qty = dqrqty(A, qraux, rank, y, ws.qty[:n])
   beta = solve_triangular(r[:rank, :rank], qty[:rank])
-  # Pivot fitted parameters to match original order of Xs columns
-  b = np.zeros(p)
+  b = ws.b
+  b[:] = 0.0
   b[:rank] = beta
+  # A full rank fit is never pivoted.
+  if rank == p:
+    return b, cov_params, rank, r, qraux
+  # Pivot fitted parameters to match original order of Xs columns
   b[jpvt] = b[range(p)]
-  scratch = np.zeros((p,p))
+  scratch = ws.scratch
+  scratch[:] = 0.0
   scratch[:rank, :rank] = cov_params
   # swap rows
   scratch[jpvt, :] = scratch[range(p), :]
@@ -25,3 +71,79 @@ def lm(X, y):
   scratch[:, jpvt] = scratch[:, range(p)]
   cov_params = scratch
   return b, cov_params, rank, r, qraux
+
+# Stacked back substitution: solutions [m][p][q] of r x = b for upper
+# triangular [m][p][p] `r` and [m][p][q] `b`, or [m][p] for [m][p] `b`.
+def msolve_upper(r, b):
+  x = np.array(b, dtype=r.dtype)
+  vec = x.ndim == 2
+  if vec:
+    x = x[..., np.newaxis]
+  p = r.shape[1]
+  for i in range(p - 1, -1, -1):
+    x[:, i] -= np.einsum("mj,mjq->mq", r[:, i, i+1:], x[:, i+1:])
+    x[:, i] /= r[:, i, i, np.newaxis]
+  return x[..., 0] if vec else x
+
+# Stacked forward substitution: solutions of r.T x = b, as `msolve_upper`.
+def msolve_upper_t(r, b):
+  x = np.array(b, dtype=r.dtype)
+  vec = x.ndim == 2
+  if vec:
+    x = x[..., np.newaxis]
+  p = r.shape[1]
+  for i in range(p):
+    x[:, i] -= np.einsum("mj,mjq->mq", r[:, :i, i], x[:, :i])
+    x[:, i] /= r[:, i, i, np.newaxis]
+  return x[..., 0] if vec else x
+
+# Stacked `lm` for `m` independent systems, `X` is [m][n][p] and `y` [m][n].
+# Also returns the pivots `jpvt` of each fit.
+def mlm(X, y):
+  return mlm_shared(X, y, np.arange(X.shape[0]))
+
+# `mlm` for responses that share designs, e.g. pixels with the same nan
+# mask: `X` [G][n][p] is factorised once per design and response `i` of
+# `y` [m][n] is fitted on design `gids[i]`. Returns the parameters [m][p]
+# per response, and the covariance, rank, factor, `qraux` and pivots per
+# design. Each fit is computed as by `mlm` on its own.
+def mlm_shared(X, y, gids):
+  G,n,p = X.shape
+  m = gids.size
+  A, rank, qraux, jpvt = mdqrdc2(X.copy(), n, p)
+  r = np.triu(A[:, :p, :p])
+  qty = mdqrqty(A, qraux, rank, y.reshape(m, n), gids)
+  b = np.zeros((m,p), dtype=X.dtype)
+  scratch = np.zeros((G,p,p), dtype=X.dtype)
+  # Systems are solved in groups of equal rank.
+  ranks = rank[gids]
+  for rk in np.unique(rank):
+    if rk == 0:
+      continue
+    g = np.flatnonzero(rank == rk)
+    # dqrdc2 does not check the last column of a square design, so an
+    # exactly singular factor gets nans, as R's back substitution would
+    # give, rather than an error.
+    rg = r[g, :rk, :rk]
+    singular = np.any(np.diagonal(rg, axis1=1, axis2=2) == 0.0, axis=1)
+    ok = ~singular
+    rok = rg[ok]
+    # (X.T X)^{-1} and the parameters by triangular solves with r.T and r,
+    # as `cho_solve` and `solve_triangular` in `lm`. An explicit inverse of
+    # r has a much larger rounding error in single precision.
+    identity = np.broadcast_to(np.identity(rk, dtype=X.dtype), rok.shape)
+    scratch[g, :rk, :rk] = np.nan
+    scratch[g[ok], :rk, :rk] = msolve_upper(rok, msolve_upper_t(rok,
+                                                                 identity))
+    gpos = np.full(G, -1, dtype=np.int64)
+    gpos[g[ok]] = np.arange(rok.shape[0])
+    i = np.flatnonzero(ranks == rk)
+    b[i, :rk] = np.nan
+    i = i[gpos[gids[i]] >= 0]
+    b[i, :rk] = msolve_upper(rok[gpos[gids[i]]], qty[i, :rk])
+  # Pivot fitted parameters to match original order of Xs columns
+  invp = np.argsort(jpvt, axis=1)
+  b = b[np.arange(m)[:, np.newaxis], invp[gids]]
+  gs = np.arange(G)[:, np.newaxis, np.newaxis]
+  cov_params = scratch[gs, invp[:, :, np.newaxis], invp[:, np.newaxis, :]]
+  return b, cov_params, rank, r, qraux, jpvt
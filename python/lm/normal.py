@@ -0,0 +1,95 @@
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
+from .lm import msolve_upper, msolve_upper_t
+
+# Least squares through the normal equations X'X b = X'y, solved by
+# Cholesky factorisation, as strucchangeRcpp does for well conditioned
+# systems instead of a pivoted QR factorisation. The check refits of
+# `recresid` and `mrecresid` with `solver="chol"` update X'X and X'y with
+# each observation and solve them here. Above `cond_tol` the rounding
+# error of the normal equations is too large and `None` (or a false entry
+# in the mask) is returned; the caller falls back to the pivoted QR fit.
+#
+# The condition number is that of X'X scaled to a unit diagonal, in the
+# 1-norm. It comes at little cost from the covariance (X'X)^(-1), which is
+# needed anyway. The rounding errors of Cholesky factorisation do not
+# depend on the scale of the columns, while the condition number of X'X
+# itself does: with a trend column it grows with the square of the
+# series length, and would reject most fits of long series.
+#
+# The default bounds the rounding errors by 1e-3 sqrt(eps), well below
+# the sqrt(eps)/k tolerance of the stability check of `recresid`. In
+# single precision this bound is below 3, so the normal equations are
+# rarely used.
+def default_cond_tol(dtype=np.float64):
+  return 1e-3 / np.sqrt(np.finfo(dtype).eps)
+
+# 1-norm condition numbers of [..][p][p] `XtX` scaled to a unit diagonal,
+# from their inverses `cov_params`.
+def scaled_cond(XtX, cov_params):
+  d = np.sqrt(np.maximum(np.diagonal(XtX, axis1=-2, axis2=-1), 0.0))
+  with np.errstate(divide="ignore", invalid="ignore"):
+    norm = np.einsum("...ij,...i->...j", np.abs(XtX), 1/d) / d
+    norm_inv = np.einsum("...ij,...i->...j", np.abs(cov_params), d) * d
+    return norm.max(axis=-1) * norm_inv.max(axis=-1)
+
+# Fit from `XtX` [p][p] and `Xty` [p]. Returns the parameters, their
+# covariance and the Cholesky factor `c` with c'c = X'X, which is the
+# triangular factor of a QR factorisation of X up to signs, or `None`.
+# `identity` is as in `lm_qr`.
+def lm_normal(XtX, Xty, cond_tol=None, identity=None):
+  p, _ = XtX.shape
+  if cond_tol is None:
+    cond_tol = default_cond_tol(XtX.dtype)
+  if identity is None:
+    identity = np.identity(p, dtype=XtX.dtype)
+  try:
+    c, _ = cho_factor(XtX, lower=False, check_finite=False)
+  except LinAlgError:
+    return None
+  cov_params = cho_solve((c, False), identity, check_finite=False)
+  if not scaled_cond(XtX, cov_params) <= cond_tol:
+    return None
+  b = cho_solve((c, False), Xty, check_finite=False)
+  return b, cov_params, np.triu(c)
+
+# Stacked Cholesky factorisation of [m][p][p] matrices. Returns upper
+# factors and a mask of the matrices that are positive definite. LAPACK
+# factorises the whole stack unless some matrix is not positive definite.
+def mcholesky(A):
+  m, p, _ = A.shape
+  try:
+    c = np.swapaxes(np.linalg.cholesky(A), 1, 2)
+    return c, np.ones(m, dtype=bool)
+  except np.linalg.LinAlgError:
+    pass
+  c = np.zeros_like(A)
+  ok = np.ones(m, dtype=bool)
+  for j in range(p):
+    d = A[:, j, j] - np.sum(c[:, :j, j]**2, axis=1)
+    ok &= d > 0.0
+    cjj = np.sqrt(np.where(d > 0.0, d, 1.0))
+    c[:, j, j] = cjj
+    c[:, j, j+1:] = (A[:, j, j+1:]
+                     - np.einsum("mi,mij->mj", c[:, :j, j],
+                                 c[:, :j, j+1:])) / cjj[:, np.newaxis]
+  return c, ok
+
+# Stacked `lm_normal`, by the triangular solves of `mlm_qr`. Returns fits
+# for all systems, their Cholesky factors and a mask of those that are
+# valid; the rest are zero and must be refitted with `mlm`.
+def mlm_normal(XtX, Xty, cond_tol=None):
+  m, p, _ = XtX.shape
+  if cond_tol is None:
+    cond_tol = default_cond_tol(XtX.dtype)
+  c, ok = mcholesky(XtX)
+  b = np.zeros((m,p), dtype=XtX.dtype)
+  cov_params = np.zeros((m,p,p), dtype=XtX.dtype)
+  if np.any(ok):
+    cok = c[ok]
+    identity = np.broadcast_to(np.identity(p, dtype=XtX.dtype), cok.shape)
+    cov_params[ok] = msolve_upper(cok, msolve_upper_t(cok, identity))
+    ok[ok] = scaled_cond(XtX[ok], cov_params[ok]) <= cond_tol
+    b[ok] = msolve_upper(c[ok], msolve_upper_t(c[ok], Xty[ok]))
+    cov_params[~ok] = 0.0
+  return b, cov_params, c, ok
@@ -0,0 +1,120 @@
+import numpy as np
+from scipy.linalg import cho_solve, solve_triangular
+from .dqrdc2 import default_qr_tol
+from .lm import msolve_upper, msolve_upper_t
+
+# Updating the QR factorisation of `X` when the row `x` (with response `y`)
+# is appended to it. Only the triangular factor `r` and the first `p`
+# entries of Q'y, `qty`, are kept. Each row is annihilated against the
+# diagonal of `r` by a sequence of Givens rotations, which costs O(p^2)
+# rather than the O(n p^2) of refactorising the whole matrix.
+# `r` and `qty` are updated in place.
+def qr_append(r, qty, x, y):
+  _, p = r.shape
+  x = x.copy()
+  for j in range(p):
+    if x[j] == 0.0:
+      continue
+    h = np.hypot(r[j,j], x[j])
+    c = r[j,j]/h
+    s = x[j]/h
+    rj = r[j,j:].copy()
+    r[j,j:] = c*rj + s*x[j:]
+    x[j:] = c*x[j:] - s*rj
+    qtyj = qty[j]
+    qty[j] = c*qtyj + s*y
+    y = c*y - s*qtyj
+  return r, qty
+
+# Least squares fit from an updated factorisation.
+#
+# dqrdc2 only pivots a column when its reduced norm falls below `tol` times
+# its original norm. For an unpivoted factor the reduced norm of column `l`
+# is |r[l,l]| and, since Q is orthogonal, the original norm is the norm of
+# the column of `X`, given here as `colnorms`. If no column is negligible
+# dqrdc2 would not have pivoted and the fit is returned as `lm` would.
+# Otherwise `None` is returned and the caller must fall back to `lm` to get
+# R's pivoting and rank decisions. `tol` defaults to that of dqrdc2 and
+# `identity` is an optional preallocated identity matrix of the size of `r`.
+def lm_qr(r, qty, colnorms, tol=None, identity=None):
+  _, p = r.shape
+  if tol is None:
+    tol = default_qr_tol(r.dtype)
+  if identity is None:
+    identity = np.identity(p, dtype=r.dtype)
+  # Zero columns are compared against a unit norm in dqrdc2.
+  colnorms = np.where(colnorms == 0.0, 1.0, colnorms)
+  if np.any(np.abs(np.diag(r)) < colnorms*tol):
+    return None
+  b = solve_triangular(r, qty)
+  cov_params = cho_solve((r, False), identity)
+  return b, cov_params, p
+
+# Stacked `qr_append` for [m][p][p] factors, appending row `x[i]` with
+# response `y[i]` to factor `i`. `r` and `qty` are updated in place.
+def mqr_append(r, qty, x, y):
+  c, s = mqr_rotate(r, x)
+  mqr_apply(c, s, qty, y)
+  return r, qty
+
+# The part of `mqr_append` that only depends on the design: updates `r`
+# in place and returns the cosines and sines [m][p] of the rotations.
+def mqr_rotate(r, x):
+  m, p, _ = r.shape
+  x = x.copy()
+  cs = np.empty((m,p), dtype=r.dtype)
+  ss = np.empty((m,p), dtype=r.dtype)
+  for j in range(p):
+    rot = x[:,j] != 0.0
+    h = np.where(rot, np.hypot(r[:,j,j], x[:,j]), 1.0)
+    c = np.where(rot, r[:,j,j]/h, 1.0)[:,np.newaxis]
+    s = np.where(rot, x[:,j]/h, 0.0)[:,np.newaxis]
+    rj = r[:,j,j:].copy()
+    r[:,j,j:] = c*rj + s*x[:,j:]
+    x[:,j:] = c*x[:,j:] - s*rj
+    cs[:,j], ss[:,j] = c[:,0], s[:,0]
+  return cs, ss
+
+# Apply rotations from `mqr_rotate` to `qty` [m][p] and the responses
+# `y` [m] of the appended rows. `qty` is updated in place.
+def mqr_apply(c, s, qty, y):
+  _, p = qty.shape
+  y = y.copy()
+  for j in range(p):
+    qtyj = qty[:,j].copy()
+    qty[:,j] = c[:,j]*qtyj + s[:,j]*y
+    y = c[:,j]*y - s[:,j]*qtyj
+  return qty
+
+# Mask of the [m][p][p] factors that `lm_qr` accepts.
+def mqr_accepts(r, colnorms, tol=None):
+  if tol is None:
+    tol = default_qr_tol(r.dtype)
+  colnorms = np.where(colnorms == 0.0, 1.0, colnorms)
+  diag = np.abs(np.diagonal(r, axis1=1, axis2=2))
+  return np.all(diag >= colnorms*tol, axis=1)
+
+# Stacked `lm_qr`, by the same triangular solves. Returns fits for all
+# factors and a mask of those that are valid; the rest are zero and must
+# be refitted with `mlm`.
+def mlm_qr(r, qty, colnorms, tol=None):
+  m, p, _ = r.shape
+  ok = mqr_accepts(r, colnorms, tol)
+  b = np.zeros((m,p), dtype=r.dtype)
+  cov_params = np.zeros((m,p,p), dtype=r.dtype)
+  if np.any(ok):
+    rok = r[ok]
+    identity = np.broadcast_to(np.identity(p, dtype=r.dtype), rok.shape)
+    b[ok] = msolve_upper(rok, qty[ok])
+    cov_params[ok] = msolve_upper(rok, msolve_upper_t(rok, identity))
+  return b, cov_params, ok
+
+# Stacked merge of the factorisations [..][p][p+1] of two row blocks of
+# a design, each its triangular factor with Q'y as the last column: the
+# factorisation of the rows of `a` followed by those of `b`, from a QR
+# factorisation of the two stacked. The merge is associative with zeros
+# as the neutral element, so the factorisations of all prefixes of a
+# series come from a scan.
+def mqr_merge(a, b):
+  p = a.shape[-2]
+  return np.linalg.qr(np.concatenate((a, b), axis=-2), mode="r")[..., :p, :]
@@ -0,0 +1,116 @@
+import numpy as np
+
+from .recresid import (_mrecresid, _mrecresid_step, _float_type,
+                       approx_equal, default_tol)
+from .lm.dqrdc2 import default_qr_tol
+from .lm.qrupdate import mqr_append, mlm_qr
+
+# Online monitoring: the recursion of `recresid` is saved per pixel after
+# the history has been processed, so that new observations can be appended
+# in O(k^2) per pixel instead of recomputing the whole series.
+#
+# A state is a dict of arrays with a leading pixel dimension:
+#   X1, bhat     (X'X)^(-1) and parameters of the recursion,
+#   rank, check  rank of the last fit and whether stability is checked,
+#   R, qty, colsq
+#                triangular factor, Q'y and squared column norms of X,
+#                used by the stability check,
+#   n            number of observations,
+#   wsum, wsumsq running sum and sum of squares of recursive residuals,
+#   tol          tolerance of the stability check.
+# Pixels with no more observations than regressors are not monitored
+# and only produce nans. States are saved with `save_state`.
+
+# State of every pixel of `ys` [m][N] with regressors `X` [N][k].
+# Also returns the recursive residuals as `mrecresid` does.
+def mrecresid_state(X, ys, tol=None):
+  _, k = X.shape
+  if tol is None:
+    tol = default_tol(k, _float_type(X, ys))
+  rets, _, _, ns, state = _mrecresid(X, ys, tol)
+  state["n"] = ns
+  state["wsum"] = np.nansum(rets, axis=1)
+  state["wsumsq"] = np.nansum(rets**2, axis=1)
+  state["tol"] = np.float64(tol)
+  return rets, state
+
+# Append one observation to all pixels. `x` [k] is the new row of the
+# regressor matrix and `ys` [m] the new values, nan where missing.
+# The state is updated in place. Returns the recursive residual and the
+# standardised recursive CUSUM at the new observation of each pixel.
+def mupdate(state, x, ys):
+  X1s, bhats = state["X1"], state["bhat"]
+  m, k = bhats.shape
+  tol = state["tol"]
+  ws = np.full(m, np.nan, dtype=bhats.dtype)
+  live = np.flatnonzero((state["n"] > k) & ~np.isnan(ys))
+
+  xs = np.broadcast_to(x, (live.size, k))
+  X1, bhat = X1s[live], bhats[live]
+  checks = state["check"][live]
+  fulls = np.flatnonzero(checks & (state["rank"][live] == k))
+  w = _mrecresid_step(X1, bhat, xs, ys[live],
+                      np.empty((live.size, k), dtype=bhats.dtype),
+                      np.empty((live.size, k, k), dtype=bhats.dtype),
+                      Rs=state["R"][live[fulls]], rows=fulls)
+  ws[live] = w
+
+  # Check numerical stability of pixels that have not yet stabilised.
+  # Without the history there is no full fit to fall back on; if
+  # dqrdc2 could have pivoted the rank is estimated from the factor
+  # and the recursion is kept.
+  cs = np.flatnonzero(checks)
+  if cs.size > 0:
+    ls = live[cs]
+    R, qty = mqr_append(state["R"][ls], state["qty"][ls], xs[cs], ys[ls])
+    state["R"][ls], state["qty"][ls] = R, qty
+    state["colsq"][ls] += xs[cs]**2
+    colnorms = np.sqrt(state["colsq"][ls])
+    b, cov_params, ok = mlm_qr(R, qty, colnorms)
+    diag = np.abs(np.diagonal(R, axis1=1, axis2=2))
+    tol_qr = default_qr_tol(R.dtype)
+    rank = np.where(ok, k, np.sum(diag >= np.where(colnorms == 0.0, 1.0,
+                                                   colnorms)*tol_qr, axis=1))
+    nona = ((rank == k) & (state["rank"][ls] == k) & ~np.isnan(w[cs]))
+    checks[cs] = ~(nona & approx_equal(b, bhat[cs], tol, axis=1))
+    X1[cs[ok]] = cov_params[ok]
+    bhat[cs[ok]] = np.nan_to_num(b[ok], nan=0.0)
+    state["rank"][ls] = rank
+    state["check"][live] = checks
+  X1s[live], bhats[live] = X1, bhat
+
+  state["n"][live] += 1
+  state["wsum"][live] += w
+  state["wsumsq"][live] += w**2
+  # Standardise as `efp` does, with the sample standard
+  # deviation of all recursive residuals so far.
+  nw = state["n"] - k
+  with np.errstate(divide="ignore", invalid="ignore"):
+    sd = np.sqrt((state["wsumsq"] - state["wsum"]**2/nw)/(nw - 1))
+    cusums = state["wsum"]/(sd*np.sqrt(nw))
+  cusums[np.isnan(ws)] = np.nan
+  return ws, cusums
+
+# Single-pixel versions of `mrecresid_state` and `mupdate`; `y` has
+# no nans. The state has no pixel dimension.
+def recresid_state(X, y, tol=None):
+  n, k = X.shape
+  rets, state = mrecresid_state(X, y.reshape(1, n), tol)
+  return rets[0, :n-k], {key: (v if key == "tol" else v[0])
+                         for key, v in state.items()}
+
+def update(state, x, y):
+  mstate = {key: (v if key == "tol" else np.asarray(v)[np.newaxis])
+            for key, v in state.items()}
+  ws, cusums = mupdate(mstate, x, np.array([y], dtype=mstate["bhat"].dtype))
+  # Scalars are not updated through views, so copy them back.
+  for key in ("rank", "check", "n", "wsum", "wsumsq"):
+    state[key] = mstate[key][0]
+  return ws[0], cusums[0]
+
+def save_state(file, state):
+  np.savez(file, **state)
+
+def load_state(file):
+  with np.load(file) as f:
+    return {key: f[key] for key in f.files}
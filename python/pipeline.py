@@ -0,0 +1,209 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .backends import resolve, module_name, load_library
+from .recresid import mrecresid, _float_type, classify_pixels, PIXEL_VALID
+from .roc import mhistory_roc
+
+# Pipelined drivers of `mrecresid` and `mhistory_roc` for images that are
+# processed in tiles of pixels, e.g. images memory-mapped by
+# `load_fut_values` that do not fit in (device) memory at once. While one
+# tile is computed, the next is read and compacted on a loader thread
+# (and copied to the device for the opencl backend), and the results of
+# the previous one are copied back and written to the output on a writer
+# thread, so that the engine does not wait on I/O.
+#
+# Tile sizes follow from a memory budget for the tiles in flight rather
+# than from a fixed number of chunks. `image` may be a `TiledImage` of
+# python/store.py, whose chunks are then read as needed.
+
+# Bytes the tiles in flight may use by default.
+DEFAULT_BUDGET = 1 << 30
+
+# Tiles loaded ahead of the one being computed.
+PREFETCH = 1
+
+# Estimated bytes per pixel used by `engine`, "mrecresid" or
+# "mhistory_roc", for series of `N` observations of `k` regressors: the
+# input, compacted and output series (and the CUSUM processes), the index
+# arrays and the k x k state of the recursion. Prefixes gathered by the
+# refits of the check phase are short-lived and not counted.
+def bytes_per_pixel(engine, N, k, dtype=np.float64):
+  itemsize = np.dtype(dtype).itemsize
+  series = {"mrecresid": 4, "mhistory_roc": 6}[engine]
+  return itemsize*(series*N + 4*k*k) + 10*N
+
+# Pixels per tile so that the tiles in flight, the one being computed,
+# those prefetched and the one being written, fit in `budget` bytes.
+def tile_size(engine, N, k, dtype=np.float64, budget=DEFAULT_BUDGET):
+  in_flight = PREFETCH + 2
+  return max(1, budget // (in_flight * bytes_per_pixel(engine, N, k, dtype)))
+
+# `size` rounded down to whole chunks of `image` if it is read in chunks of
+# pixels, e.g. a `TiledImage` from python/store.py, but at least one chunk.
+def align_tile(image, size):
+  pixels = getattr(image, "pixels", None)
+  if pixels is None:
+    return size
+  return max(1, size // pixels) * pixels
+
+# Pixel ranges (start, stop) of tiles of `size` pixels covering `m`.
+def tiles(m, size):
+  return [(i, min(i + size, m)) for i in range(0, m, size)]
+
+# Calls `write(tile, compute(tile, load(tile)))` for every tile in order,
+# running `load` of the next `PREFETCH` tiles and `write` of the previous
+# tile on background threads. Exceptions of any stage are raised here.
+# `progress(done, total)` is called with the number of pixels written.
+def run_pipeline(tiles, load, compute, write, progress=None):
+  total = tiles[-1][1] if tiles else 0
+  with ThreadPoolExecutor(1) as loader, ThreadPoolExecutor(1) as writer:
+    loads = deque(loader.submit(load, t) for t in tiles[:PREFETCH])
+    writing = None
+    for i, tile in enumerate(tiles):
+      if i + PREFETCH < len(tiles):
+        loads.append(loader.submit(load, tiles[i + PREFETCH]))
+      res = compute(tile, loads.popleft().result())
+      # At most one tile is being written.
+      if writing is not None:
+        writing.result()
+        if progress is not None:
+          progress(tiles[i-1][1], total)
+      writing = writer.submit(write, tile, res)
+    if writing is not None:
+      writing.result()
+      if progress is not None:
+        progress(total, total)
+
+# Stages for running Futhark `entry` of `module` on tiles of `image`.
+# Only pixels with more observations than regressors are passed to the
+# entry. For opencl, inputs are copied to the device by `load` and results
+# back by `fetch`, which the writer runs; the other backends convert their
+# results in `compute`, as their contexts are used from one thread only.
+def _futhark_stages(module, backend, entry, X, image, dtype, *params):
+  lib, convert = load_library(module_name(module, dtype), backend)
+  k = X.shape[1]
+  to_device = lambda a: a
+  if backend == "opencl":
+    import pyopencl.array as cl_array
+    to_device = lambda a: cl_array.to_device(lib.queue, a)
+  X_dev = to_device(np.ascontiguousarray(X, dtype=dtype))
+
+  def load(tile):
+    ys = np.ascontiguousarray(image[tile[0]:tile[1]], dtype=dtype)
+    classes, ns = classify_pixels(ys, k)
+    vs = np.flatnonzero(classes == PIXEL_VALID)
+    return ns, vs, to_device(np.ascontiguousarray(ys[vs]))
+
+  def compute(tile, data):
+    ns, vs, ys_dev = data
+    res = None
+    if vs.size > 0:
+      res = getattr(lib, entry)(*params, X_dev, ys_dev)
+      if backend != "opencl":
+        res = fetch(res)
+    return ns, vs, res
+
+  def fetch(res):
+    if isinstance(res, tuple):
+      return tuple(convert(r) for r in res)
+    return convert(res)
+
+  return load, compute, fetch if backend == "opencl" else (lambda res: res)
+
+# `mhistory_roc` of `image` [m][N] in pipelined tiles. Results are written
+# to `out` [m], e.g. a memory-mapped array, which is allocated if not given
+# and returned. `tile` pixels per tile are chosen from `budget` unless
+# given; see `mhistory_roc` for the other arguments.
+#
+# With `write`, the results of each tile are instead passed to
+# `write(start, stop, result)` on the writer thread, in order, and neither
+# kept nor returned, so that e.g. a comparison of the results never holds
+# those of the whole image.
+def mhistory_roc_tiled(X, image, alpha, confidence, out=None,
+                       backend="numpy", budget=DEFAULT_BUDGET, tile=None,
+                       progress=None, write=None):
+  backend = resolve(backend)
+  m, N = image.shape
+  k = X.shape[1]
+  dtype = _float_type(X, image)
+  if tile is None:
+    tile = align_tile(image, tile_size("mhistory_roc", N, k, dtype, budget))
+  if write is None:
+    if out is None:
+      out = np.zeros(m, dtype=np.int64)
+    def write(start, stop, starts):
+      out[start:stop] = starts
+
+  if backend == "numpy":
+    def load(t):
+      return np.ascontiguousarray(image[t[0]:t[1]], dtype=dtype)
+    def compute(t, ys):
+      return mhistory_roc(X, ys, alpha, confidence)
+    def put(t, res):
+      write(t[0], t[1], res)
+  else:
+    load, compute, fetch = _futhark_stages(
+      "mroc", backend, "mhistory_roc", X, image, dtype,
+      dtype.type(alpha), dtype.type(confidence))
+    def put(t, res):
+      _, vs, starts = res
+      block = np.zeros(t[1] - t[0], dtype=np.int64)
+      if vs.size > 0:
+        block[vs] = fetch(starts)
+      write(t[0], t[1], block)
+
+  run_pipeline(tiles(m, tile), load, compute, put, progress)
+  return out
+
+# `mrecresid` of `image` [m][N] in pipelined tiles. Recursive residuals
+# are written to `out` [m][N-k], padded with nans as `mrecresid` pads to
+# its Nbar - k columns, which is allocated if not given. Returns `out` and
+# the number of stability checks per pixel; see `mhistory_roc_tiled`.
+# `write` is passed the residuals [stop-start][N-k] and the number of
+# checks of a tile.
+def mrecresid_tiled(X, image, out=None, backend="numpy",
+                    budget=DEFAULT_BUDGET, tile=None, progress=None,
+                    write=None):
+  backend = resolve(backend)
+  m, N = image.shape
+  k = X.shape[1]
+  dtype = _float_type(X, image)
+  if tile is None:
+    tile = align_tile(image, tile_size("mrecresid", N, k, dtype, budget))
+  num_checks = None
+  if write is None:
+    if out is None:
+      out = np.empty((m, N - k), dtype=dtype)
+    num_checks = np.zeros(m, dtype=np.int64)
+    def write(start, stop, res):
+      out[start:stop], num_checks[start:stop] = res
+  rets_dtype = dtype if out is None else out.dtype
+
+  if backend == "numpy":
+    def load(t):
+      return np.ascontiguousarray(image[t[0]:t[1]], dtype=dtype)
+    def compute(t, ys):
+      return mrecresid(X, ys)
+    def put(t, res):
+      rets, checks, Nbar, _ = res
+      block = np.full((t[1] - t[0], N - k), np.nan, dtype=rets_dtype)
+      block[:, :Nbar-k] = rets
+      write(t[0], t[1], (block, checks))
+  else:
+    load, compute, fetch = _futhark_stages("recresid", backend, "mrecresid",
+                                           X, image, dtype)
+    def put(t, res):
+      ns, vs, fut = res
+      block = np.full((t[1] - t[0], N - k), np.nan, dtype=rets_dtype)
+      checks_block = np.zeros(t[1] - t[0], dtype=np.int64)
+      if vs.size > 0:
+        retsT, checks, Nbar, _ = fetch(fut)
+        block[vs, :Nbar-k] = retsT.T
+        checks_block[vs] = checks
+      block[np.arange(N - k) >= (ns - k)[:, np.newaxis]] = np.nan
+      write(t[0], t[1], (block, checks_block))
+
+  run_pipeline(tiles(m, tile), load, compute, put, progress)
+  return out, num_checks
@@ -0,0 +1,43 @@
+import numpy as np
+
+# Ragged arrays in compressed sparse row (CSR) form: row `j` is
+# `values[offsets[j]:offsets[j+1]]`. `mrecresid` returns its residuals
+# in this form with `csr=True`, a row per pixel with a residual for each
+# observation after the first `k`, so that memory and transfers are
+# proportional to the observations rather than to m (Nbar-k). Rows are
+# views of `values`; nothing is copied.
+class Ragged:
+  def __init__(self, values, offsets):
+    self.values = values
+    self.offsets = offsets
+
+  def __len__(self):
+    return self.offsets.size - 1
+
+  def __getitem__(self, j):
+    return self.values[self.offsets[j]:self.offsets[j+1]]
+
+  @property
+  def lengths(self):
+    return np.diff(self.offsets)
+
+  # Rows as an [m][width] array padded with `fill`, as `mrecresid`
+  # returns them without `csr`. `width` defaults to the longest row.
+  def to_padded(self, width=None, fill=np.nan):
+    lengths = self.lengths
+    if width is None:
+      width = np.max(lengths, initial=0)
+    out = np.full((len(self), width), fill, dtype=self.values.dtype)
+    out[np.arange(width) < lengths[:, np.newaxis]] = self.values
+    return out
+
+# Offsets of rows of `lengths`.
+def offsets_of(lengths):
+  offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=offsets[1:])
+  return offsets
+
+# `Ragged` of the first `lengths[j]` values of row `j` of `padded`.
+def from_padded(padded, lengths):
+  mask = np.arange(padded.shape[1]) < lengths[:, np.newaxis]
+  return Ragged(padded[mask], offsets_of(lengths))
@@ -1,5 +1,14 @@
-from python.lm.lm import lm
+from python.lm.lm import (lm, mlm, mlm_shared, msolve_upper,
+                          msolve_upper_t, LmWorkspace, check_solver)
+from python.lm.normal import lm_normal, mlm_normal
+from python.lm.qrupdate import (qr_append, lm_qr, mqr_append, mlm_qr,
+                                mqr_rotate, mqr_apply, mqr_accepts,
+                                mqr_merge)
 import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.linalg.blas import get_blas_funcs
+from python.backends import resolve, module_name, futhark_call
+from python.ragged import Ragged, offsets_of, from_padded
 
 def _nonans(xs):
   return not np.any(np.isnan(xs))
@@ -26,56 +35,810 @@ def all_equal(target, current, tol):
 #
 # This is the armadillo version, which is simply
 # an absolute difference |x - y| <= tol.
-def approx_equal(x, y, tol):
-  return np.mean(np.abs(x - y)) <= tol
+def approx_equal(x, y, tol, axis=None):
+  return np.mean(np.abs(x - y), axis=axis) <= tol
 
-def recresid(X, y, tol=None):
+# Default tolerance of the stability check for `k` regressors, scaled
+# with the precision of `dtype` so that single precision is not checked
+# against double precision rounding.
+def default_tol(k, dtype=np.float64):
+  return np.sqrt(np.finfo(dtype).eps) / k
+
+# Floating point type of the computation on `X` and `y`. Single precision
+# is kept; anything else is computed in double precision.
+def _float_type(X, y):
+  return np.result_type(X.dtype, y.dtype, np.float32)
+
+# Preallocated buffers for `recresid` on series of at most `n`
+# observations of `k` regressors. Passing the same workspace to
+# `recresid` for every pixel avoids allocating in the recursion.
+class RecresidWorkspace:
+  def __init__(self, n, k, dtype=np.float64):
+    self.n = n
+    self.dtype = np.dtype(dtype)
+    self.lm = LmWorkspace(n, k, dtype)
+    # Fortran order so that BLAS updates it in place.
+    self.X1 = np.empty((k, k), dtype=dtype, order="F")
+    self.bhat = np.empty(k, dtype=dtype)
+    self.d = np.empty(k, dtype=dtype)
+    self.R = np.empty((k, k), dtype=dtype)
+    self.qty = np.empty(k, dtype=dtype)
+    self.colsq = np.empty(k, dtype=dtype)
+    self.XtX = np.empty((k, k), dtype=dtype)
+    self.Xty = np.empty(k, dtype=dtype)
+    # Scratch of the check refits.
+    self.xsq = np.empty(k, dtype=dtype)
+    self.xxT = np.empty((k, k), dtype=dtype)
+    self.colnorms = np.empty(k, dtype=dtype)
+    self.identity = np.identity(k, dtype=dtype)
+    self.gemv, self.ger, self.dot = get_blas_funcs(("gemv", "ger", "dot"),
+                                                   dtype=dtype)
+
+# Triangular factor of `X` (and Q'y) for updating check refits,
+# written to `R`, `qty` and `colsq`.
+# Reuses the factor computed by dqrdc2 unless it was pivoted.
+def _qr_init(X, y, b, rank, r, R, qty, colsq):
+  n, k = X.shape
+  if rank == k:
+    R[:] = r
+    np.dot(r, b, out=qty)
+  else:
+    R[:] = 0.0
+    qty[:] = 0.0
+    for i in range(n):
+      qr_append(R, qty, X[i], y[i])
+  np.einsum("ij,ij->j", X, X, out=colsq)
+
+# Refit after appending row `x` and response `y` to the factorisation.
+# Falls back to a full `lm` fit of `X`, `y` whenever
+# dqrdc2 could have made different pivoting decisions.
+# `ws` is the `RecresidWorkspace` of the recursion.
+def _lm_append(R, qty, colsq, x, y, X, y_full, ws, profile=None):
+  qr_append(R, qty, x, y)
+  colsq += np.multiply(x, x, out=ws.xsq)
+  fit = lm_qr(R, qty, np.sqrt(colsq, out=ws.colnorms),
+              identity=ws.identity)
+  if profile is not None:
+    profile.refits += 1
+    profile.full_refits += fit is None
+  if fit is None:
+    b, cov_params, rank, _, _ = lm(X, y_full, ws.lm)
+    return b, cov_params, rank
+  return fit
+
+# `_lm_append` by the normal equations: X'X and X'y are updated and
+# solved by Cholesky factorisation, with a full `lm` fit whenever X'X is
+# not well conditioned. The triangular factor of the fit is written to
+# `R`, where it has full rank.
+def _lm_append_normal(XtX, Xty, R, x, y, X, y_full, ws, profile=None):
+  XtX += np.multiply.outer(x, x, out=ws.xxT)
+  Xty += np.multiply(x, y, out=ws.xsq)
+  fit = lm_normal(XtX, Xty, identity=ws.identity)
+  if profile is not None:
+    profile.refits += 1
+    profile.full_refits += fit is None
+  if fit is None:
+    b, cov_params, rank, r, _ = lm(X, y_full, ws.lm)
+    if rank == b.size:
+      R[:] = r
+    return b, cov_params, rank
+  b, cov_params, R[:] = fit
+  return b, cov_params, b.size
+
+# Stacked `_qr_init` for [m][n][k] designs. With `gids` as in
+# `mlm_shared`, `X`, `rank` and `r` are per design and `y` and `b` per
+# response.
+def _mqr_init(X, y, b, rank, r, gids=None):
+  G, n, k = X.shape
+  if gids is None:
+    gids = np.arange(G)
+  full = rank == k
+  R = np.where(full[:, np.newaxis, np.newaxis], r, 0.0)
+  qty = np.where(full[gids, np.newaxis],
+                 np.einsum("mij,mj->mi", r[gids], b), 0.0)
+  pivoted = np.flatnonzero(~full)
+  if pivoted.size > 0:
+    ps = np.flatnonzero(~full[gids])
+    pos = np.empty(G, dtype=np.int64)
+    pos[pivoted] = np.arange(pivoted.size)
+    pg = pos[gids[ps]]
+    Rp, qtyp = R[pivoted], qty[ps]
+    for i in range(n):
+      c, s = mqr_rotate(Rp, X[pivoted, i])
+      mqr_apply(c[pg], s[pg], qtyp, y[ps, i])
+    R[pivoted], qty[ps] = Rp, qtyp
+  return R, qty, np.sum(X**2, axis=1)
+
+# Rows per block of the scan of `_recresid_scan`.
+SCAN_BLOCK = 64
+
+# Recursive residuals of [m][n][k] designs `Xs` and responses `ys` [m][n],
+# zero padded after the first `ns` observations, with time as a parallel
+# dimension: the triangular factor R and Q'y of every prefix come from a
+# prefix scan with `mqr_merge` (python/lm/qrupdate.py), on which zero
+# padding has no effect, and each prefix is fitted independently from
+# them as the check refits of `_mrecresid` are: by the inverse of R, or
+# where dqrdc2 could have pivoted by `mlm` on the k x k system for its
+# pivoting and rank decisions. Nothing is sequential. Residuals are exact
+# fits rather than updates, so they differ from the recursion's by its
+# accumulated rounding.
+#
+# Time is scanned in blocks of `SCAN_BLOCK` rows by Hillis-Steele, each
+# starting from the factorisation of the rows before it, which bounds the
+# memory by m SCAN_BLOCK k (k+1). Returns the residuals [m][n-k] and the
+# number of prefixes of each pixel fitted by `mlm`.
+def _recresid_scan(Xs, ys, ns, profile=None):
+  m, n, k = Xs.shape
+  if profile is not None:
+    t = profile.start()
+  dtype = Xs.dtype
+  rets = np.empty((m, n - k), dtype=dtype)
+  fallbacks = np.zeros(m, dtype=np.int64)
+  # [R | Q'y] and squared column norms of the rows before the block.
+  carry = np.zeros((m, k, k + 1), dtype=dtype)
+  colsq = np.zeros((m, k), dtype=dtype)
+  for s in range(0, n, SCAN_BLOCK):
+    e = min(s + SCAN_BLOCK, n)
+    B = e - s
+    # Each row is the first row of its own factorisation.
+    fac = np.zeros((m, B, k, k + 1), dtype=dtype)
+    fac[:, :, 0, :k] = Xs[:, s:e]
+    fac[:, :, 0, k] = ys[:, s:e]
+    d = 1
+    while d < B:
+      fac[:, d:] = mqr_merge(fac[:, :-d], fac[:, d:])
+      d *= 2
+    fac = mqr_merge(np.broadcast_to(carry[:, np.newaxis], fac.shape), fac)
+    colsqs = colsq[:, np.newaxis] + np.cumsum(Xs[:, s:e]**2, axis=1)
+    # The fit of the first r observations predicts observation r.
+    lo = max(k, s)
+    if lo < e:
+      prev = np.concatenate((carry[:, np.newaxis], fac[:, :-1]), axis=1)
+      prev = prev[:, lo-s:].reshape(-1, k, k + 1)
+      prev_colsq = np.concatenate((colsq[:, np.newaxis], colsqs[:, :-1]),
+                                  axis=1)[:, lo-s:].reshape(-1, k)
+      R, qty = prev[:, :, :k], prev[:, :, k]
+      x = Xs[:, lo:e].reshape(-1, k)
+      # 1 + x'(R'R)^(-1)x as 1 + |R'^(-1)x|^2, which cannot fall below 1
+      # by rounding, and the parameters by triangular solves.
+      ok = mqr_accepts(R, np.sqrt(prev_colsq))
+      b = np.zeros((R.shape[0], k), dtype=dtype)
+      fr = np.ones(R.shape[0], dtype=dtype)
+      if np.any(ok):
+        b[ok] = msolve_upper(R[ok], qty[ok])
+        fr[ok] += np.sum(msolve_upper_t(R[ok], x[ok])**2, axis=1)
+      fs = np.flatnonzero(~ok)
+      if fs.size > 0:
+        bf, cov_params, _, _, _, _ = mlm(R[fs], qty[fs])
+        b[fs] = np.nan_to_num(bf, nan=0.0)
+        fr[fs] = 1 + np.einsum("mi,mij,mj->m", x[fs],
+                               np.nan_to_num(cov_params, nan=0.0), x[fs])
+      w = (ys[:, lo:e].reshape(-1) - np.sum(x*b, axis=1)) / np.sqrt(fr)
+      rets[:, lo-k:e-k] = w.reshape(m, e - lo)
+      fallbacks += np.sum(~ok.reshape(m, e - lo)
+                          & (np.arange(lo, e) < ns[:, np.newaxis]), axis=1)
+    carry = fac[:, -1]
+    colsq = colsqs[:, -1]
+  if profile is not None:
+    profile.stop("scan", t)
+    profile.refits += np.sum(np.maximum(ns - k, 0))
+    profile.full_refits += np.sum(fallbacks)
+  return rets, fallbacks
+
+# `profile` is an optional `Profile` from python/instrument.py.
+#
+# With `scan` the residuals are computed by `_recresid_scan`, in parallel
+# over time, rather than by the sequential recursion; `tol`, `ws` and
+# `solver` are not used. This suits few long series.
+#
+# `solver` is the solver of the check refits, "qr" or "chol" (see
+# python/lm/lm.py); with "chol" they solve the normal equations, which
+# are updated with each observation, rather than updating the QR
+# factorisation.
+def recresid(X, y, tol=None, ws=None, profile=None, scan=False,
+             solver="qr"):
+    check_solver(solver)
     n, k = X.shape
     assert(n == y.shape[0])
     if n == 0:
+      if profile is not None:
+        profile.add_pixels(0)
       return np.array([])
 
+    if scan:
+        dtype = _float_type(X, y)
+        ret, fallbacks = _recresid_scan(X[np.newaxis].astype(dtype),
+                                        y.reshape(1, n).astype(dtype),
+                                        np.array([n]), profile)
+        if profile is not None:
+            profile.add_pixels(fallbacks)
+        return ret[0]
+
+    if ws is None:
+        ws = RecresidWorkspace(n, k, _float_type(X, y))
+    assert(n <= ws.n)
+
     if tol is None:
-        tol = np.sqrt(np.finfo(np.float64).eps) / k
+        tol = default_tol(k, ws.dtype)
 
-    y = y.reshape(n, 1)
-    ret = np.zeros(n - k)
+    y = y.reshape(n)
+    ret = np.zeros(n - k, dtype=ws.dtype)
+
+    if profile is not None:
+        t = profile.start()
 
     # initialize recursion
-    yh = y[:k] # k x 1
+    yh = y[:k] # k
     Xh = X[:k] # k x k
-    b, cov_params, rank, _, _ = lm(Xh, yh)
+    b, cov_params, rank, r, _ = lm(Xh, yh, ws.lm)
+    R, qty, colsq = ws.R, ws.qty, ws.colsq
+    _qr_init(Xh, yh, b, rank, r, R, qty, colsq)
+    XtX, Xty = ws.XtX, ws.Xty
+    if solver == "chol":
+        np.dot(Xh.T, Xh, out=XtX)
+        np.dot(Xh.T, yh, out=Xty)
 
-    X1 = cov_params # (X'X)^(-1), k x k
-    inds = np.isnan(X1)
-    X1[inds] = 0.0
-    bhat = np.nan_to_num(b, 0.0) # k x 1
+    X1 = ws.X1 # (X'X)^(-1), k x k
+    X1[:] = cov_params
+    np.nan_to_num(X1, copy=False)
+    bhat = ws.bhat # k
+    bhat[:] = b
+    np.nan_to_num(bhat, copy=False)
 
+    d = ws.d
+    gemv, ger, dot = ws.gemv, ws.ger, ws.dot
     check = True
+    num_checks = 0
+    if profile is not None:
+        profile.stop("init", t)
+        if rank < k:
+            profile.add_rank_deficient(0, k-1, rank)
+        t = profile.start()
     for r in range(k, n):
         prev_rank = rank
         # Compute recursive residual
         x = X[r]
-        d = X1 @ x
-        fr = 1 + np.dot(x, d)
-        resid = y[r] - np.nansum(x * bhat) # dotprod ignoring nans
+        gemv(1.0, X1, x, y=d, overwrite_y=True) # d = X1 x
+        if check and prev_rank == k:
+            # X1 = (R'R)^(-1) is formed explicitly, and on badly
+            # conditioned first fits in single precision x'X1 x is lost
+            # to rounding. While checked, the factor R of the prefix is
+            # at hand and gives it as |R'^(-1)x|^2 to working precision.
+            fr = ws.dtype.type(1.0) + np.sum(
+                solve_triangular(R, x, trans="T")**2)
+        else:
+            fr = ws.dtype.type(1.0) + dot(x, d)
+        # fr >= 1 for the positive semidefinite X1. Clamped rather than
+        # giving nan residuals and flipping the sign of the downdate
+        # where X1 is lost to rounding anyway.
+        fr = max(fr, ws.dtype.type(1.0))
+        xb = dot(x, bhat)
+        if np.isnan(xb):
+          xb = np.nansum(x * bhat) # dotprod ignoring nans
+        resid = y[r] - xb
         ret[r-k] = resid / np.sqrt(fr)
 
-        # Update formulas
-        X1 = X1 - (np.outer(d, d))/fr
-        bhat += X1 @ x * resid
+        # Update formulas, in place.
+        # X1 = X1 - dd'/fr
+        ger(-1/fr, d, d, a=X1, overwrite_a=True)
+        # bhat = bhat + X1 x * resid
+        gemv(resid, X1, x, beta=1.0, y=bhat, overwrite_y=True)
 
         # Check numerical stability (rectify if unstable).
         if check:
-            # We check update formula value against full OLS fit
-            b, cov_params, rank, _, _ = lm(X[:r+1], y[:r+1])
+            # We check update formula value against full OLS fit,
+            # obtained by updating the previous factorisation.
+            if solver == "chol":
+                b, cov_params, rank = _lm_append_normal(XtX, Xty, R, x,
+                                                        y[r], X[:r+1],
+                                                        y[:r+1], ws,
+                                                        profile)
+            else:
+                b, cov_params, rank = _lm_append(R, qty, colsq, x, y[r],
+                                                 X[:r+1], y[:r+1], ws,
+                                                 profile)
             # R checks nans in fitted parameters; same as rank.
             # Also check on latest recresidual, because fr may
             # be nan.
             nona = (rank == k and prev_rank == k
                               and not np.isnan(ret[r-k]))
             check = not (nona and approx_equal(b, bhat, tol))
-            X1 = cov_params
-            bhat = np.nan_to_num(b, 0.0)
+            X1[:] = cov_params
+            bhat[:] = b
+            np.nan_to_num(bhat, copy=False)
+            num_checks += 1
+            if profile is not None:
+                if rank < k:
+                    profile.add_rank_deficient(0, r, rank)
+                if not check:
+                    profile.stop("check", t)
+                    t = profile.start()
 
+    if profile is not None:
+        profile.stop("check" if check else "unchecked", t)
+        profile.add_pixels(num_checks)
     return ret
+
+# Recursive residuals `y - x'bhat` (scaled) of one step for all pixels,
+# updating `X1s` and `bhats` in place. `d` and `ddT` are buffers. With
+# `gids` pixels share X1: `X1s`, `x`, `d` and `ddT` are per group, and
+# pixel `i` is in group `gids[i]`.
+#
+# `rows` of `X1s` that still have the full rank factor `Rs` of their
+# prefix, i.e. are checked, take fr from it rather than from X1; see
+# `recresid`.
+def _mrecresid_step(X1s, bhats, x, y, d, ddT, gids=None, Rs=None, rows=None):
+  np.einsum("mij,mj->mi", X1s, x, out=d)
+  fr = 1 + np.einsum("mi,mi->m", x, d)
+  if rows is not None and rows.size > 0:
+    fr[rows] = 1 + np.sum(msolve_upper_t(Rs, x[rows])**2, axis=1)
+  # Clamped as in `recresid`.
+  np.maximum(fr, 1, out=fr)
+  xp, frp = (x, fr) if gids is None else (x[gids], fr[gids])
+  resid = y - np.nansum(xp * bhats, axis=1)
+  w = resid / np.sqrt(frp)
+
+  # Update formulas, in place.
+  # X1 = X1 - dd'/fr
+  np.multiply(d[:, :, np.newaxis], d[:, np.newaxis, :], out=ddT)
+  ddT /= fr[:, np.newaxis, np.newaxis]
+  X1s -= ddT
+  # bhat = bhat + X1 x * resid
+  np.einsum("mij,mj->mi", X1s, x, out=d)
+  if gids is None:
+    d *= resid[:, np.newaxis]
+    bhats += d
+  else:
+    bhats += d[gids] * resid[:, np.newaxis]
+  return w
+
+# Map-distributed `recresid`. There may be nan values in `ys`.
+# Mirrors `mrecresid` in recresid.fut, except that residuals are
+# returned as [m][Nbar-k] rather than transposed, and the number
+# of stability checks is reported per pixel.
+#
+# With `group_masks` the work that only depends on the design is shared
+# by pixels with the same nan mask; see `_mrecresid_grouped`.
+#
+# `backend` selects the engine, see python/backends.py. The Futhark
+# engines use the default tolerance.
+#
+# `solver` is the solver of the check refits as in `recresid`; "chol" is
+# only available with the numpy backend, without `group_masks` and
+# `scan`.
+#
+# With `scan` every pixel is computed as by `recresid` with `scan`, which
+# gives parallelism over time for images of few pixels with long series.
+# The number of prefixes fitted by `mlm` is reported in place of the
+# number of stability checks.
+#
+# With `csr` residuals are returned as a `Ragged` from python/ragged.py,
+# with the residuals of the observations of each pixel only, in place of
+# the padded [m][Nbar-k] array. The recursion writes them in this form
+# directly; with `scan` or `group_masks` the padded residuals are
+# converted.
+def mrecresid(X, ys, tol=None, group_masks=False, profile=None,
+              backend="numpy", scan=False, csr=False, solver="qr"):
+  check_solver(solver)
+  if group_masks and scan:
+    raise ValueError("group_masks and scan are exclusive")
+  backend = resolve(backend)
+  if solver != "qr" and (group_masks or scan or backend != "numpy"):
+    raise ValueError("the {} solver requires the numpy backend without "
+                     "group_masks and scan".format(solver))
+  if backend != "numpy":
+    if tol is not None or profile is not None:
+      raise ValueError("tol and profile require the numpy backend")
+    return _mrecresid_futhark(X, ys, group_masks, backend, scan, csr)
+  if not (scan or group_masks):
+    rets, num_checks, Nbar, ns, _ = _mrecresid(X, ys, tol, profile, csr,
+                                               solver)
+    return rets, num_checks, Nbar, ns
+  if scan:
+    rets, num_checks, Nbar, ns = _mrecresid_scan(X, ys, profile)
+  else:
+    rets, num_checks, Nbar, ns = _mrecresid_grouped(X, ys, tol, profile)
+  if csr:
+    rets = from_padded(rets, np.maximum(ns - X.shape[1], 0))
+  return rets, num_checks, Nbar, ns
+
+# Classes of pixels of `ys` [m][N] with `k` regressors: without
+# observations (no-data), with too few to fit the first `k`, and valid.
+# The batched engines only run valid pixels and give the others sentinel
+# outputs: nan residuals, no stability checks and a stable history
+# starting at 0.
+PIXEL_EMPTY = 0
+PIXEL_SHORT = 1
+PIXEL_VALID = 2
+
+# Class of each pixel and its number of observations.
+def classify_pixels(ys, k):
+  ns = ys.shape[1] - np.sum(np.isnan(ys), axis=1)
+  classes = np.where(ns > k, PIXEL_VALID,
+                     np.where(ns > 0, PIXEL_SHORT, PIXEL_EMPTY))
+  return classes.astype(np.int8), ns
+
+# Group the pixels of `ys` [m][N] by nan mask. Returns the group of
+# each pixel and a representative pixel of each group.
+def nan_mask_groups(ys):
+  packed = np.packbits(np.isnan(ys), axis=1)
+  _, reps, gids = np.unique(packed, axis=0, return_index=True,
+                            return_inverse=True)
+  return gids.reshape(-1), reps
+
+# `mrecresid`, also returning the state of each pixel's recursion
+# after its last observation. With `csr` the residuals are written to a
+# `Ragged` as they are computed, without a padded array. The state of the
+# "chol" solver holds X'X and X'y in place of Q'y and the column norms.
+def _mrecresid(X, ys, tol=None, profile=None, csr=False, solver="qr"):
+  N, k = X.shape
+  m, _ = ys.shape
+  assert(N == ys.shape[1])
+
+  dtype = _float_type(X, ys)
+  if tol is None:
+    tol = default_tol(k, dtype)
+
+  # Only valid pixels are run; see `classify_pixels`.
+  classes, ns = classify_pixels(ys, k)
+  vs = np.flatnonzero(classes == PIXEL_VALID)
+  ys_v = ys[vs]
+  ns_v = ns[vs]
+  mv = vs.size
+
+  # Rearrange `ys` so that valid values come before nans. Rows of `X`
+  # are read through the same indices as needed rather than repeated
+  # for every pixel, as `mrecresid_gather` in recresid.fut does.
+  indss_nn = np.argsort(np.isnan(ys_v), axis=1, kind="stable")
+  # Upper bound on number of non-nans
+  Nbar = max(np.max(ns, initial=0), k)
+  indss_nn = indss_nn[:, :Nbar]
+  ys_nn = np.take_along_axis(ys_v, indss_nn, axis=1).astype(dtype, copy=False)
+  # Zero padding leaves the recursion of shorter pixels unchanged; padding
+  # indexes a row of zeros appended to `X`.
+  pad = np.arange(Nbar) >= ns_v[:, np.newaxis]
+  Xp = np.zeros((N + 1, k), dtype=dtype)
+  Xp[:N] = X
+  indss_nn[pad] = N
+  ys_nn[pad] = 0.0
+
+  if csr:
+    offsets = offsets_of(np.maximum(ns - k, 0))
+    values = np.empty(offsets[-1], dtype=dtype)
+    starts = offsets[vs]
+  else:
+    rets_v = np.empty((mv, Nbar - k), dtype=dtype)
+  num_checks_v = np.zeros(mv, dtype=np.int64)
+
+  if profile is not None:
+    t = profile.start()
+
+  # Initialise recursion by fitting on first `k` observations.
+  Xk = Xp[indss_nn[:, :k]]
+  b, cov_params, ranks, R, _, _ = mlm(Xk, ys_nn[:, :k])
+  Rs, qtys, colsqs = _mqr_init(Xk, ys_nn[:, :k], b, ranks, R)
+  if solver == "chol":
+    XtXs = np.einsum("mij,mil->mjl", Xk, Xk)
+    Xtys = np.einsum("mij,mi->mj", Xk, ys_nn[:, :k])
+  X1s = np.nan_to_num(cov_params, nan=0.0)
+  bhats = np.nan_to_num(b, nan=0.0)
+
+  if profile is not None:
+    profile.stop("init", t)
+    deficient = np.flatnonzero(ranks < k)
+    profile.add_rank_deficient(vs[deficient], k-1, ranks[deficient])
+
+  # Buffers reused by every step of the recursion.
+  d = np.empty((mv, k), dtype=dtype)
+  ddT = np.empty((mv, k, k), dtype=dtype)
+  checks = np.ones(mv, dtype=bool)
+  # Whether each pixel is still checked after its own last observation,
+  # for the state; `checks` is cleared on the padding after it.
+  last_checks = np.zeros(mv, dtype=bool)
+  for r in range(k, Nbar):
+    if profile is not None:
+      t = profile.start()
+    prev_ranks = ranks.copy()
+    # Compute recursive residuals for all pixels at once.
+    x = Xp[indss_nn[:, r]] # mv x k
+    fulls = np.flatnonzero(checks & (ranks == k))
+    w = _mrecresid_step(X1s, bhats, x, ys_nn[:, r], d, ddT,
+                        Rs=Rs[fulls], rows=fulls)
+    if csr:
+      live = np.flatnonzero(r < ns_v)
+      values[starts[live] + (r-k)] = w[live]
+    else:
+      rets_v[:, r-k] = w
+
+    # Check numerical stability of pixels that have not yet stabilised.
+    checks &= r < ns_v
+    cs = np.flatnonzero(checks)
+    if cs.size > 0:
+      if solver == "chol":
+        # Refit by updating and solving the normal equations, keeping
+        # the factor for fr.
+        XtXs[cs] += x[cs, :, np.newaxis] * x[cs, np.newaxis, :]
+        Xtys[cs] += x[cs] * ys_nn[cs, r, np.newaxis]
+        b, cov_params, c, ok = mlm_normal(XtXs[cs], Xtys[cs])
+        Rs[cs[ok]] = c[ok]
+      else:
+        # Refit by appending the new row to each factorisation.
+        R, qty = mqr_append(Rs[cs], qtys[cs], x[cs], ys_nn[cs, r])
+        Rs[cs], qtys[cs] = R, qty
+        colsqs[cs] += x[cs]**2
+        b, cov_params, ok = mlm_qr(R, qty, np.sqrt(colsqs[cs]))
+      ranks[cs] = k
+      # Full fit where dqrdc2 could have pivoted, or where the normal
+      # equations are not well conditioned. The k x k system R b = Q'y
+      # has the column norms of the design, so dqrdc2 makes the same
+      # pivoting and rank decisions on it as on the prefix; the normal
+      # equations have no such system and the prefix is refitted.
+      fs = cs[~ok]
+      if fs.size > 0:
+        if solver == "chol":
+          b[~ok], cov_params[~ok], ranks[fs], Rs[fs], _, _ = \
+            mlm(Xp[indss_nn[fs, :r+1]], ys_nn[fs, :r+1])
+        else:
+          b[~ok], cov_params[~ok], ranks[fs], _, _, _ = mlm(Rs[fs], qtys[fs])
+      nona = ((ranks[cs] == k) & (prev_ranks[cs] == k)
+                               & ~np.isnan(w[cs]))
+      checks[cs] = ~(nona & approx_equal(b, bhats[cs], tol, axis=1))
+      X1s[cs] = cov_params
+      bhats[cs] = np.nan_to_num(b, nan=0.0)
+      num_checks_v[cs] += 1
+      if profile is not None:
+        profile.refits += cs.size
+        profile.full_refits += fs.size
+        deficient = cs[ranks[cs] < k]
+        profile.add_rank_deficient(vs[deficient], r, ranks[deficient])
+    last = np.flatnonzero(ns_v == r + 1)
+    last_checks[last] = checks[last]
+    if profile is not None:
+      profile.stop("check" if cs.size > 0 else "unchecked", t)
+
+  if csr:
+    # Other pixels have no residuals.
+    rets = Ragged(values, offsets)
+  else:
+    rets_v[pad[:, k:]] = np.nan
+    # Scatter back, with the sentinels of `classify_pixels` elsewhere.
+    rets = np.full((m, Nbar - k), np.nan, dtype=dtype)
+    rets[vs] = rets_v
+  num_checks = np.zeros(m, dtype=np.int64)
+  num_checks[vs] = num_checks_v
+  if profile is not None:
+    profile.add_pixels(num_checks)
+  # Padding leaves the other entries unchanged: its zero rows neither
+  # update the recursion nor are appended to the factorisations.
+  state = {"X1": X1s, "bhat": bhats, "rank": ranks, "check": last_checks,
+           "R": Rs}
+  if solver == "chol":
+    state.update(XtX=XtXs, Xty=Xtys)
+  else:
+    state.update(qty=qtys, colsq=colsqs)
+  for key, v in state.items():
+    state[key] = np.zeros((m,) + v.shape[1:], dtype=v.dtype)
+    state[key][vs] = v
+  return rets, num_checks, Nbar, ns, state
+
+# `mrecresid` by `_recresid_scan` on the valid pixels.
+def _mrecresid_scan(X, ys, profile=None):
+  N, k = X.shape
+  m, _ = ys.shape
+  assert(N == ys.shape[1])
+  dtype = _float_type(X, ys)
+
+  classes, ns = classify_pixels(ys, k)
+  vs = np.flatnonzero(classes == PIXEL_VALID)
+  Nbar = max(np.max(ns, initial=0), k)
+  rets = np.full((m, Nbar - k), np.nan, dtype=dtype)
+  num_checks = np.zeros(m, dtype=np.int64)
+  if vs.size > 0:
+    # Valid values first, zero padded as in `_mrecresid`.
+    indss_nn = np.argsort(np.isnan(ys[vs]), axis=1, kind="stable")[:, :Nbar]
+    pad = np.arange(Nbar) >= ns[vs, np.newaxis]
+    Xs_nn = X.astype(dtype, copy=False)[indss_nn]
+    Xs_nn[pad] = 0.0
+    ys_nn = np.take_along_axis(ys[vs], indss_nn,
+                               axis=1).astype(dtype, copy=False)
+    ys_nn[pad] = 0.0
+    rets_v, num_checks[vs] = _recresid_scan(Xs_nn, ys_nn, ns[vs], profile)
+    rets_v[pad[:, k:]] = np.nan
+    rets[vs] = rets_v
+  if profile is not None:
+    profile.add_pixels(num_checks)
+  return rets, num_checks, Nbar, ns
+
+# `mrecresid` for images where many pixels share a nan mask, e.g. whole
+# scenes lost to clouds. Pixels with the same mask have the same design,
+# so the factor R, the Givens rotations, ranks and covariances are
+# computed once per group, and only bhat, Q'y and the residuals per pixel.
+# Refits where dqrdc2 could have pivoted also factorise R once per group,
+# by `mlm_shared`.
+#
+# X1 is shared by the pixels of a group that stop checking at the same
+# step, which are all of them unless their responses make them stop at
+# different steps; pixels that stop apart from the rest of their group
+# get a copy of X1 that is downdated on its own. Every pixel thus sees
+# the same operations as in `_mrecresid`, and the results are the same.
+def _mrecresid_grouped(X, ys, tol=None, profile=None):
+  N, k = X.shape
+  m, _ = ys.shape
+  assert(N == ys.shape[1])
+
+  dtype = _float_type(X, ys)
+  if tol is None:
+    tol = default_tol(k, dtype)
+
+  nans = np.isnan(ys)
+  classes, ns = classify_pixels(ys, k)
+  Nbar = max(np.max(ns, initial=0), k)
+  rets = np.full((m, Nbar - k), np.nan, dtype=dtype)
+  num_checks = np.zeros(m, dtype=np.int64)
+  # Only valid pixels are run, as in `_mrecresid`.
+  vs = np.flatnonzero(classes == PIXEL_VALID)
+  if vs.size == 0:
+    if profile is not None:
+      profile.add_pixels(num_checks)
+    return rets, num_checks, Nbar, ns
+  gids, reps = nan_mask_groups(ys[vs])
+  G = reps.size
+  ns_v = ns[vs]
+
+  # One design per group, zero padded as in `_mrecresid`.
+  indss_nn = np.argsort(nans[vs[reps]], axis=1, kind="stable")[:, :Nbar]
+  Xs_nn = X.astype(dtype, copy=False)[indss_nn] # G x Nbar x k
+  Xs_nn[np.arange(Nbar) >= ns[vs[reps], np.newaxis]] = 0.0
+  ys_nn = np.take_along_axis(ys[vs], indss_nn[gids],
+                             axis=1).astype(dtype, copy=False)
+  pad = np.arange(Nbar) >= ns_v[:, np.newaxis]
+  ys_nn[pad] = 0.0
+
+  if profile is not None:
+    t = profile.start()
+
+  # Initialise recursion by fitting on first `k` observations.
+  b, cov_params, ranks, R, _, _ = mlm_shared(Xs_nn[:, :k], ys_nn[:, :k], gids)
+  Rs, qtys, colsqs = _mqr_init(Xs_nn[:, :k], ys_nn[:, :k], b, ranks, R, gids)
+  # X1 of each set of pixels `hids` that share it, and their design.
+  X1s = np.nan_to_num(cov_params, nan=0.0)
+  hids = gids.copy()
+  designs = np.arange(G)
+  bhats = np.nan_to_num(b, nan=0.0)
+  if profile is not None:
+    profile.stop("init", t)
+    deficient = np.flatnonzero(ranks[gids] < k)
+    profile.add_rank_deficient(vs[deficient], k-1, ranks[gids[deficient]])
+
+  rets_v = np.empty((vs.size, Nbar - k), dtype=dtype)
+  d = np.empty((G, k), dtype=dtype)
+  ddT = np.empty((G, k, k), dtype=dtype)
+  gpos = np.empty(G, dtype=np.int64)
+  checks = np.ones(vs.size, dtype=bool)
+  for r in range(k, Nbar):
+    if profile is not None:
+      t = profile.start()
+    prev_ranks = ranks.copy()
+    # Compute recursive residuals, the design-only part once per X1.
+    H = designs.size
+    fulls = np.unique(hids[checks & (ranks[gids] == k)])
+    w = _mrecresid_step(X1s, bhats, Xs_nn[designs, r], ys_nn[:, r], d, ddT,
+                        hids, Rs[designs[fulls]], fulls)
+    rets_v[:, r-k] = w
+
+    # Check numerical stability of pixels that have not yet stabilised.
+    # Those of a group share one X1.
+    checks &= r < ns_v
+    cs = np.flatnonzero(checks)
+    if cs.size > 0:
+      hs = np.unique(hids[cs])
+      gs = designs[hs]
+      gpos[gs] = np.arange(gs.size)
+      gc = gpos[gids[cs]]
+      # Refit by appending the new row to each group's factorisation
+      # and rotating Q'y of each pixel along.
+      R = Rs[gs]
+      x = Xs_nn[gs, r]
+      c, s = mqr_rotate(R, x)
+      Rs[gs] = R
+      colsqs[gs] += x**2
+      qty = qtys[cs]
+      mqr_apply(c[gc], s[gc], qty, ys_nn[cs, r])
+      qtys[cs] = qty
+      # As `mlm_qr`, with the covariance once per group.
+      ok = mqr_accepts(R, np.sqrt(colsqs[gs]))
+      b = np.zeros((cs.size, k), dtype=dtype)
+      cov_params = np.zeros((gs.size, k, k), dtype=dtype)
+      if np.any(ok):
+        identity = np.broadcast_to(np.identity(k, dtype=dtype),
+                                   (np.sum(ok), k, k))
+        cov_params[ok] = msolve_upper(R[ok], msolve_upper_t(R[ok], identity))
+        okc = ok[gc]
+        b[okc] = msolve_upper(R[gc[okc]], qty[okc])
+      ranks[gs] = k
+      # Full fit where dqrdc2 could have pivoted, on R b = Q'y as in
+      # `_mrecresid`, factorising each group's R once.
+      fgs = np.flatnonzero(~ok)
+      fs = np.flatnonzero(~ok[gc])
+      if fgs.size > 0:
+        fpos = np.empty(gs.size, dtype=np.int64)
+        fpos[fgs] = np.arange(fgs.size)
+        b[fs], cov_params[fgs], ranks[gs[fgs]], _, _, _ = \
+          mlm_shared(R[fgs], qty[fs], fpos[gc[fs]])
+      nona = ((ranks[gids[cs]] == k) & (prev_ranks[gids[cs]] == k)
+                                     & ~np.isnan(w[cs]))
+      checks[cs] = ~(nona & approx_equal(b, bhats[cs], tol, axis=1))
+      X1s[hs] = cov_params
+      bhats[cs] = np.nan_to_num(b, nan=0.0)
+      num_checks[vs[cs]] += 1
+      # Pixels that stop while others of their group go on checking get
+      # their own copy of X1.
+      going = np.zeros(H, dtype=bool)
+      going[hids[cs[checks[cs]]]] = True
+      stop = cs[~checks[cs]]
+      stop = stop[going[hids[stop]]]
+      if stop.size > 0:
+        split, inv = np.unique(hids[stop], return_inverse=True)
+        hids[stop] = H + inv
+        X1s = np.concatenate((X1s, X1s[split]))
+        designs = np.concatenate((designs, designs[split]))
+        d = np.empty((designs.size, k), dtype=dtype)
+        ddT = np.empty((designs.size, k, k), dtype=dtype)
+      if profile is not None:
+        profile.refits += cs.size
+        profile.full_refits += fs.size
+        deficient = cs[ranks[gids[cs]] < k]
+        profile.add_rank_deficient(vs[deficient], r,
+                                   ranks[gids[deficient]])
+    if profile is not None:
+      profile.stop("check" if cs.size > 0 else "unchecked", t)
+
+  if profile is not None:
+    profile.add_pixels(num_checks)
+  rets_v[pad[:, k:]] = np.nan
+  rets[vs] = rets_v
+  return rets, num_checks, Nbar, ns
+
+# `mrecresid` through the Futhark entries. `mrecresid` skips invalid
+# pixels itself, but `mrecresid_grouped` requires every pixel to be
+# valid; in both cases they are left out here, which also saves the
+# transfer.
+def _mrecresid_futhark(X, ys, group_masks, backend, scan=False, csr=False):
+  N, k = X.shape
+  m, _ = ys.shape
+  assert(N == ys.shape[1])
+  dtype = _float_type(X, ys)
+  X = np.ascontiguousarray(X, dtype=dtype)
+  ys = np.ascontiguousarray(ys, dtype=dtype)
+  module = module_name("recresid", dtype)
+
+  classes, ns = classify_pixels(ys, k)
+  Nbar = max(np.max(ns, initial=0), k)
+  num_checks = np.zeros(m, dtype=np.int64)
+  vs = np.flatnonzero(classes == PIXEL_VALID)
+  lens = np.maximum(ns - k, 0)
+  if csr and not (group_masks or scan):
+    # Only the residuals of observations are transferred. Invalid pixels
+    # have none, so the offsets of the valid pixels carry over.
+    values = np.zeros(0, dtype=dtype)
+    if vs.size > 0:
+      values, _, num_checks[vs] = futhark_call(module, backend,
+                                               "mrecresid_csr", X, ys[vs])
+    return Ragged(values, offsets_of(lens)), num_checks, Nbar, ns
+
+  rets = np.full((m, Nbar - k), np.nan, dtype=dtype)
+  if vs.size > 0:
+    if group_masks:
+      gids, reps = nan_mask_groups(ys[vs])
+      retsT, checks, _, _ = futhark_call(module, backend, "mrecresid_grouped",
+                                         X, ys[vs], gids.astype(np.int64),
+                                         reps.astype(np.int64))
+    else:
+      entry = "mrecresid_scan" if scan else "mrecresid"
+      retsT, checks, _, _ = futhark_call(module, backend, entry, X, ys[vs])
+    rets[vs] = retsT.T
+    num_checks[vs] = checks
+  rets[np.arange(Nbar - k) >= (ns - k)[:, np.newaxis]] = np.nan
+  if csr:
+    return from_padded(rets, lens), num_checks, Nbar, ns
+  return rets, num_checks, Nbar, ns
@@ -1,23 +1,71 @@
+import math
 import numpy as np
-from scipy import stats, optimize
 
-from .recresid import recresid
+from .recresid import (recresid, mrecresid, _float_type, classify_pixels,
+                       PIXEL_VALID)
+from .backends import resolve, module_name, futhark_call
 
 # From Brown, Durbin, Evans (1975).
 def _pval_brownian_motion_max(x):
+    from scipy import stats
     Q = lambda x: 1 - stats.norm.cdf(x, loc=0, scale=1)
     p = 2 * (Q(3*x) + np.exp(-4*x**2) - np.exp(-4*x**2)*Q(x))
     return p
 
 def compute_confidence_brownian(alpha):
+  from scipy import optimize
   return optimize.brentq(lambda x: _pval_brownian_motion_max(x) - alpha, 0, 20)
 
-def efp(X, y):
+# Fast p-values and critical values from a table of log p on [0, 8] in
+# steps of 2^-12, built with the standard library on first use. The
+# second derivatives of p and of log p are bounded by 8.1 on [0, 8], so
+# linear interpolation has an absolute error below 1e-7 in p, a relative
+# error below 1e-7 in p, and an error below 1e-7 in critical values for
+# 1e-12 <= alpha <= 1 (measured against `_pval_exact` by bisection).
+# Statistics beyond the table get p(8) < 1e-110.
+_PVAL_STEP = 2.0**-12
+_PVAL_MAX = 8.0
+_pval_table = None
+
+def _pval_exact(x):
+  Q = lambda x: 0.5*math.erfc(x/math.sqrt(2))
+  e = math.exp(-4*x**2)
+  return 2*(Q(3*x) + e - e*Q(x))
+
+def _log_pval_table():
+  global _pval_table
+  if _pval_table is None:
+    xs = np.arange(0, _PVAL_MAX + _PVAL_STEP/2, _PVAL_STEP)
+    _pval_table = (xs, np.log([_pval_exact(x) for x in xs]))
+  return _pval_table
+
+# `_pval_brownian_motion_max` of an array of statistics.
+def pval_brownian_motion_max(x):
+  _, logps = _log_pval_table()
+  x = np.asarray(x, dtype=np.float64)
+  nan = np.isnan(x)
+  # The table is uniform, so the cell is found by scaling.
+  t = np.clip(np.where(nan, 0.0, x), 0.0, _PVAL_MAX) / _PVAL_STEP
+  i = np.minimum(t.astype(np.int64), logps.size - 2)
+  t -= i
+  return np.where(nan, np.nan, np.exp(logps[i] + t*(logps[i+1] - logps[i])))
+
+# `compute_confidence_brownian` of an array of levels.
+def confidence_brownian(alpha):
+  xs, logps = _log_pval_table()
+  with np.errstate(divide="ignore"):
+    return np.interp(np.log(alpha), logps[::-1], xs[::-1])
+
+def efp(X, y, profile=None):
   # Recursive CUSUM process
   k, n = X.shape
-  w  = recresid(X.T, y)
+  w  = recresid(X.T, y, profile=profile)
+  if profile is not None:
+    t = profile.start()
   sigma = np.std(w, ddof=1) # division by `N-1` to match R's `sd` function.
   process = np.cumsum(np.append([0],w))/(sigma*np.sqrt(n-k))
+  if profile is not None:
+    profile.stop("cusum", t)
   return process
 
 # Linear boundary for Brownian motion (limiting process of rec.resid. CUSUM).
@@ -36,13 +84,9 @@ def sctest(process):
     stat = np.max(np.abs(x))
     return _pval_brownian_motion_max(stat)
 
-def history_roc(X, y, alpha, confidence):
-  if y.shape[0] == 0: return 0
-  X_rev = np.flip(X, axis=1)
-  y_rev = y[::-1]
-  rcus = efp(X_rev, y_rev)
-
-  pval = sctest(rcus)
+# Stable history start from the reversed CUSUM process `rcus` and its
+# p-value at one level, the only part of `history_roc` that depends on it.
+def _history_start(rcus, pval, alpha, confidence):
   y_start = 0
   if not np.isnan(pval) and pval < alpha:
       bounds = boundary(rcus, confidence)
@@ -50,6 +94,30 @@ def history_roc(X, y, alpha, confidence):
       y_start = rcus.size - np.min(inds) - 1 if inds.size > 0 else 0
   return y_start
 
+# `profile` is an optional `Profile` from python/instrument.py.
+def history_roc(X, y, alpha, confidence, profile=None):
+  return history_roc_levels(X, y, [(alpha, confidence)], profile)[0]
+
+# `history_roc` at each of the `(alpha, confidence)` pairs of `levels`
+# from one computation of the recursive residuals and CUSUM process.
+def history_roc_levels(X, y, levels, profile=None):
+  if y.shape[0] == 0: return np.zeros(len(levels), dtype=np.int64)
+  X_rev = np.flip(X, axis=1)
+  y_rev = y[::-1]
+  rcus = efp(X_rev, y_rev, profile)
+
+  if profile is not None:
+    t = profile.start()
+  pval = sctest(rcus)
+  if profile is not None:
+    profile.stop("sctest", t)
+    t = profile.start()
+  y_starts = np.array([_history_start(rcus, pval, alpha, confidence)
+                       for alpha, confidence in levels], dtype=np.int64)
+  if profile is not None:
+    profile.stop("boundary", t)
+  return y_starts
+
 def history_roc_debug(X, y, alpha, confidence):
   X_rev = np.flip(X, axis=1)
   y_rev = y[::-1]
@@ -64,3 +132,138 @@ def history_roc_debug(X, y, alpha, confidence):
       y_start = rcus.size - np.min(inds) - 1 if inds.size > 0 else 0
       pval_pass = True
   return y_start, pval_pass, rcus
+
+# Batched versions of the above for many pixels at once, mirroring
+# `rcusum`, `sctest`, `boundary` and `mhistory_roc` in mroc.fut.
+# Recursive residuals are given as a padded [m][n] matrix `ws` with
+# the number of valid residuals `ns` of each pixel, as returned by
+# `mrecresid` (with `ns` less `k`). Processes are [m][n+1] with the
+# initial zero and nans after the valid part.
+
+# Sample standard deviation of each row of `ws`, ignoring nans, with
+# `ns` the number of non-nan values; as `sample_sd_nan` in mroc.fut.
+def msample_sd_nan(ws, ns):
+  with np.errstate(divide="ignore", invalid="ignore"):
+    mean = np.nansum(ws, axis=1) / ns
+    diffs = np.where(np.isnan(ws), 0.0, ws - mean[:, np.newaxis])
+    return np.sqrt(np.sum(diffs**2, axis=1) / (ns - 1))
+
+# Standardised recursive CUSUM processes.
+def mefp(ws, ns):
+  m, n = ws.shape
+  valid = np.arange(n) < ns[:, np.newaxis]
+  sd = msample_sd_nan(np.where(valid, ws, np.nan), ns)
+  process = np.zeros((m, n + 1), dtype=ws.dtype)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    np.cumsum(ws / (sd * np.sqrt(ns))[:, np.newaxis], axis=1,
+              out=process[:, 1:])
+  process[:, 1:][~valid] = np.nan
+  return process
+
+# P-values of the structural change test of each process.
+def msctest(process, ns):
+  _, n1 = process.shape
+  x = process[:, 1:]
+  # Weights 1/(1 + 2j) with j = 1/n, 2/n, ..., 1 for each pixel.
+  with np.errstate(divide="ignore", invalid="ignore"):
+    j = np.arange(1, n1) / ns[:, np.newaxis]
+    x = np.abs(x) / (1 + 2*j)
+  x[np.arange(n1 - 1) >= ns[:, np.newaxis]] = 0.0
+  stat = np.max(x, axis=1, initial=0.0)
+  stat[ns <= 0] = np.nan
+  return pval_brownian_motion_max(stat)
+
+# Linear boundaries of all processes, nan after the valid part.
+def mboundary(ns, n, confidence):
+  i = np.arange(n + 1)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    bounds = confidence + 2*confidence*i / ns[:, np.newaxis]
+  bounds[i > ns[:, np.newaxis]] = np.nan
+  return bounds
+
+# Index into `process[:, 1:]` of the first point outside the boundary,
+# or -1 if there is none.
+def mcrossings(process, ns, confidence):
+  _, n1 = process.shape
+  bounds = mboundary(ns, n1 - 1, confidence)
+  cross = np.abs(process[:, 1:]) > bounds[:, 1:]
+  return np.where(np.any(cross, axis=1), np.argmax(cross, axis=1), -1)
+
+# Stable history start of every pixel in `ys` [m][N], with regressors
+# `X` [N][k]; nans are missing values. Pixels with no more observations
+# than regressors have no stable history and get 0; only the others are
+# run, see `classify_pixels`.
+# `profile` is an optional `Profile` from python/instrument.py.
+# `backend` selects the engine, see python/backends.py.
+def mhistory_roc(X, ys, alpha, confidence, profile=None, backend="numpy"):
+  backend = resolve(backend)
+  if backend != "numpy":
+    if profile is not None:
+      raise ValueError("profile requires the numpy backend")
+    return _mhistory_roc_futhark(X, ys, alpha, confidence, backend)
+  return mhistory_roc_levels(X, ys, [(alpha, confidence)], profile)[0]
+
+# `mhistory_roc` at each of the `(alpha, confidence)` pairs of `levels`,
+# as a [levels][m] matrix. The recursive residuals, CUSUM processes and
+# p-values are computed once; only the boundary crossings are per level.
+def mhistory_roc_levels(X, ys, levels, profile=None, backend="numpy"):
+  backend = resolve(backend)
+  alphas, confidences = np.array(levels, dtype=np.float64).reshape(-1, 2).T
+  if backend != "numpy":
+    if profile is not None:
+      raise ValueError("profile requires the numpy backend")
+    return _mhistory_roc_levels_futhark(X, ys, alphas, confidences, backend)
+  _, k = X.shape
+  ws, _, _, ns = mrecresid(X[::-1], ys[:, ::-1], profile=profile)
+  out = np.zeros((alphas.size, ys.shape[0]), dtype=np.int64)
+  vs = np.flatnonzero(ns > k)
+  ws = ws[vs]
+  ns = ns[vs] - k
+  if profile is not None:
+    t = profile.start()
+  process = mefp(ws, ns)
+  if profile is not None:
+    profile.stop("cusum", t)
+    t = profile.start()
+  pvals = msctest(process, ns)
+  if profile is not None:
+    profile.stop("sctest", t)
+    t = profile.start()
+  for l, (alpha, confidence) in enumerate(zip(alphas, confidences)):
+    inds = mcrossings(process, ns, confidence)
+    chk = ~np.isnan(pvals) & (pvals < alpha) & (inds >= 0)
+    out[l, vs] = np.where(chk, ns - inds, 0)
+  if profile is not None:
+    profile.stop("boundary", t)
+  return out
+
+# Inputs of the Futhark entries of mroc.fut in their floating point type,
+# with the valid pixels `vs` of `ys`. The entries skip invalid pixels
+# themselves, but they are left out here already to save the transfer.
+def _mroc_inputs(X, ys):
+  N, k = X.shape
+  dtype = _float_type(X, ys)
+  X = np.ascontiguousarray(X, dtype=dtype)
+  ys = np.ascontiguousarray(ys, dtype=dtype)
+  classes, _ = classify_pixels(ys, k)
+  return X, ys, np.flatnonzero(classes == PIXEL_VALID), dtype
+
+# `mhistory_roc` through the Futhark entry.
+def _mhistory_roc_futhark(X, ys, alpha, confidence, backend):
+  X, ys, vs, dtype = _mroc_inputs(X, ys)
+  out = np.zeros(ys.shape[0], dtype=np.int64)
+  if vs.size > 0:
+    out[vs] = futhark_call(module_name("mroc", dtype), backend,
+                           "mhistory_roc", dtype.type(alpha),
+                           dtype.type(confidence), X, ys[vs])
+  return out
+
+# `mhistory_roc_levels` through the Futhark entry.
+def _mhistory_roc_levels_futhark(X, ys, alphas, confidences, backend):
+  X, ys, vs, dtype = _mroc_inputs(X, ys)
+  out = np.zeros((alphas.size, ys.shape[0]), dtype=np.int64)
+  if vs.size > 0 and alphas.size > 0:
+    out[:, vs] = futhark_call(module_name("mroc", dtype), backend,
+                              "mhistory_roc_levels", alphas.astype(dtype),
+                              confidences.astype(dtype), X, ys[vs])
+  return out
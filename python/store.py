@@ -0,0 +1,158 @@
+import json
+import os
+import zlib
+import numpy as np
+
+# Tiled on-disk store of an image [m][N] and its regressors, for images
+# too large to load at once. The image is split into chunks of `pixels`
+# pixels by `times` observations; a directory holds
+#   meta.json   shape, type, chunk shape and compression of the image,
+#   index.npy   [P][T][2] byte offset and size of each chunk in chunks.bin,
+#   chunks.bin  the chunks, row-major, each compressed on its own if
+#               `compression` is "zlib",
+#   Xt.npy      the regressors [k][N], as the first value of a data file.
+# convert_tiles.py converts the data files of load_dataset.py.
+# Uncompressed chunks are memory-mapped, so reading a tile only touches
+# its pages. Chunks of whole series (the default) are read straight into
+# the engines: a `TiledImage` has the `shape`, `dtype` and slicing by
+# pixels that `mhistory_roc_tiled` and `mrecresid_tiled` use, whose tiles
+# are aligned to the chunks.
+
+VERSION = 1
+COMPRESSIONS = (None, "zlib")
+
+# Pixels per chunk by default.
+DEFAULT_PIXELS = 4096
+
+# Write `image` [m][N], which may be memory-mapped, and `Xt` [k][N] to the
+# store at `path`, reading `pixels` pixels at a time. `times` defaults to
+# whole series.
+def write_tiled(path, Xt, image, pixels=DEFAULT_PIXELS, times=None,
+                compression=None, level=6, dtype=None):
+  if compression not in COMPRESSIONS:
+    raise ValueError("Unknown compression {!r}, expected one of {}"
+                     .format(compression, COMPRESSIONS))
+  m, N = image.shape
+  dtype = np.dtype(dtype if dtype is not None else image.dtype)
+  if times is None:
+    times = max(N, 1)
+  P, T = -(-m // pixels), -(-N // times)
+  index = np.zeros((P, T, 2), dtype=np.int64)
+  os.makedirs(path, exist_ok=True)
+  offset = 0
+  with open(os.path.join(path, "chunks.bin"), "wb") as f:
+    for p in range(P):
+      block = np.ascontiguousarray(image[p*pixels:(p+1)*pixels], dtype=dtype)
+      for t in range(T):
+        data = np.ascontiguousarray(block[:, t*times:(t+1)*times]).tobytes()
+        if compression == "zlib":
+          data = zlib.compress(data, level)
+        f.write(data)
+        index[p, t] = offset, len(data)
+        offset += len(data)
+  np.save(os.path.join(path, "Xt.npy"), np.asarray(Xt, dtype=dtype))
+  np.save(os.path.join(path, "index.npy"), index)
+  # meta.json is written last, and atomically by renaming, so that a store
+  # is only complete with it.
+  meta = {"version": VERSION, "shape": [m, N], "dtype": dtype.str,
+          "chunk": [pixels, times], "compression": compression}
+  tmp = os.path.join(path, "meta.json.tmp")
+  with open(tmp, "w") as f:
+    json.dump(meta, f)
+  os.replace(tmp, os.path.join(path, "meta.json"))
+
+# Reader of a store written by `write_tiled`. Safe to use from several
+# threads, e.g. by the loader of python/pipeline.py.
+class TiledImage:
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, "meta.json")) as f:
+      meta = json.load(f)
+    if meta["version"] != VERSION:
+      raise ValueError("Unsupported store version {} in {}"
+                       .format(meta["version"], path))
+    self.shape = tuple(meta["shape"])
+    self.dtype = np.dtype(meta["dtype"])
+    self.pixels, self.times = meta["chunk"]
+    self.compression = meta["compression"]
+    self.index = np.load(os.path.join(path, "index.npy"))
+    data = os.path.join(path, "chunks.bin")
+    # Uncompressed chunks are views of one mapping of chunks.bin.
+    # Compressed chunks are read with `os.pread`, which does not move a
+    # shared file position.
+    self._map = None
+    self._fd = None
+    if self.compression is None:
+      if os.path.getsize(data) > 0:
+        self._map = np.memmap(data, dtype=np.uint8, mode="r")
+    else:
+      self._fd = os.open(data, os.O_RDONLY)
+
+  def close(self):
+    self._map = None
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return self.shape[0]
+
+  def load_Xt(self):
+    return np.load(os.path.join(self.path, "Xt.npy"))
+
+  # Pixel ranges (start, stop) of the chunks, which can be read and
+  # processed independently.
+  def tiles(self):
+    m = self.shape[0]
+    return [(i, min(i + self.pixels, m)) for i in range(0, m, self.pixels)]
+
+  # Chunk `t` of pixel block `p`.
+  def _chunk(self, p, t):
+    m, N = self.shape
+    shape = (min(self.pixels, m - p*self.pixels),
+             min(self.times, N - t*self.times))
+    offset, size = self.index[p, t]
+    if self.compression is None:
+      if size == 0:
+        return np.empty(shape, dtype=self.dtype)
+      return self._map[offset:offset+size].view(self.dtype).reshape(shape)
+    data = zlib.decompress(os.pread(self._fd, int(size), int(offset)))
+    return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+  # Pixels `start` to `stop` [stop-start][N]. Within one chunk of whole
+  # series this is a view of the chunk, memory-mapped if uncompressed.
+  def read(self, start, stop):
+    m, N = self.shape
+    start, stop = max(0, start), min(stop, m)
+    stop = max(start, stop)
+    first, last = start // self.pixels, -(-stop // self.pixels)
+    T = self.index.shape[1]
+    if T == 1 and last - first == 1:
+      p0 = first*self.pixels
+      return self._chunk(first, 0)[start-p0:stop-p0]
+    out = np.empty((stop - start, N), dtype=self.dtype)
+    for p in range(first, last):
+      p0 = p*self.pixels
+      a, b = max(start, p0), min(stop, p0 + self.pixels)
+      for t in range(T):
+        out[a-start:b-start, t*self.times:(t+1)*self.times] = \
+          self._chunk(p, t)[a-p0:b-p0]
+    return out
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      start, stop, step = key.indices(self.shape[0])
+      if step != 1:
+        raise IndexError("Only contiguous pixel ranges can be read")
+      return self.read(start, stop)
+    if key < 0:
+      key += self.shape[0]
+    if not 0 <= key < self.shape[0]:
+      raise IndexError("Pixel {} out of range".format(key))
+    return self.read(key, key + 1)[0]
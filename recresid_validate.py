@@ -1,57 +1,49 @@
-import os
 from datetime import timedelta
 from timeit import default_timer as timer
 import numpy as np
-from python.recresid import recresid
-from recresid_pyopencl import recresid_pyopencl
+from python.recresid import mrecresid, recresid
+from python.cache import ResultCache
+from python.pipeline import mrecresid_tiled, tile_size, tiles
 
-recresid_fut = recresid_pyopencl()
+# The image is split into tiles sized from the memory budget of
+# python/pipeline.py; the opencl results are computed by its pipelined
+# driver and compared tile by tile as they are written, so that the
+# results of the whole image are never held at once. Besides the batched
+# `mrecresid`, every tile is compared with the per-pixel `recresid`, the
+# reference, on a sample of `SAMPLE` pixels.
+SAMPLE = 50
 
-def validate(name, chunks, X, image, cache_dir=".cache/recresid"):
+def validate(name, X, image, cache_dir=".cache/recresid"):
   print("image size", image.shape)
   print("regressor matrix", X.shape)
   k = X.shape[1]
   m, N = image.shape
-  for i, image_chunk in enumerate(np.array_split(image, chunks)):
-    print("~~ chunk {} ({}/{})".format(image_chunk.shape, i+1, chunks))
+  cache = ResultCache(cache_dir)
+  tile = tile_size("mrecresid", N, k)
+  chunks = tiles(m, tile)
+
+  def compare(start, stop, ocl):
+    i = start // tile
+    ocl_res, ocl_checks = ocl
+    image_chunk = image[start:stop]
+    print("~~ chunk {} ({}/{})".format(image_chunk.shape, i+1, len(chunks)))
     print("Computing python results...", end="")
-    if not os.path.isdir(cache_dir):
-      os.makedirs(cache_dir)
-    py_res_file = "{}/{}.chunk{}.npy".format(cache_dir, name, i)
     num_recresids_padded = N-k
-    if os.path.exists(py_res_file):
-      with open(py_res_file, "rb") as f:
-        py_res = np.load(f)
-      print("loaded from", py_res_file)
+    key = cache.key("mrecresid", X, image_chunk, tol=None)
+    py_res = cache.get(key)
+    if py_res is not None:
+      print("loaded from cache ({} chunk {})".format(name, i))
     else:
       py_res = np.empty((image_chunk.shape[0],num_recresids_padded))
       py_res.fill(np.nan)
       t_start = timer()
-      for i, y in enumerate(image_chunk):
-        nan_inds = np.isnan(y)
-        ynn = y[~nan_inds]
-        Xnn = X[~nan_inds]
-        # with np.errstate(invalid='raise'):
-        #   try:
-        #     res = recresid(Xnn, ynn)
-        #   except:
-        #     print("at chunk pixel", i)
-        res = recresid(Xnn, ynn)
-        if res.size > 0:
-          py_res[i,:res.size] = res
+      res, _, py_Nbar, _ = mrecresid(X, image_chunk)
+      py_res[:,:py_Nbar-k] = res
       t_stop = timer()
       print(timedelta(seconds=t_stop-t_start))
-      with open(py_res_file, "wb") as f:
-        np.save(f, py_res)
+      cache.put(key, py_res)
 
-    print("Computing opencl results...", end="")
-    t_start = timer()
-    ocl_resT, num_checks, Nbar, _ = recresid_fut.mrecresid(X, image_chunk)
-    t_stop = timer()
-    ocl_res = np.empty((image_chunk.shape[0],num_recresids_padded))
-    ocl_res.fill(np.nan)
-    ocl_res[:,:Nbar-k] = ocl_resT.get().T
-    print(timedelta(seconds=t_stop-t_start))
+    num_checks = np.max(ocl_checks, initial=0)
 
     check = np.allclose(py_res, ocl_res, equal_nan=True)
     print("np.allclose (rtol=1e-5, atol=1e-8):", end="")
@@ -69,6 +61,27 @@ def validate(name, chunks, X, image, cache_dir=".cache/recresid"):
       print("Python", py_res[inds])
       print("Futhark", ocl_res[inds])
 
+    sample = np.unique(np.linspace(0, image_chunk.shape[0] - 1,
+                                   min(SAMPLE, image_chunk.shape[0]))
+                       .astype(np.int64))
+    failed = []
+    for j in sample:
+      y = image_chunk[j]
+      nn = ~np.isnan(y)
+      if np.sum(nn) <= k:
+        continue
+      ref = recresid(X[nn], y[nn])
+      if not np.allclose(ref, ocl_res[j, :ref.size]):
+        failed.append(j)
+    print("per-pixel recresid on {} sampled pixels:".format(sample.size),
+          end="")
+    if not failed:
+      print("\033[92m PASSED \033[0m")
+    else:
+      print("\033[91m FAILED \033[0m")
+      print("Sampled pixels that differ (chunk pixel index)")
+      print(failed)
+
     print("Number of stability checks:", num_checks)
 
     print("Relative absolute error")
@@ -82,3 +95,7 @@ def validate(name, chunks, X, image, cache_dir=".cache/recresid"):
     print("Mean error {:10.5e} ({:.4f}%)".format(np.mean(rel_err),
                                                  np.mean(per_err)))
 
+  t_start = timer()
+  mrecresid_tiled(X, image, backend="opencl", tile=tile, write=compare)
+  t_stop = timer()
+  print("Total time with opencl results:", timedelta(seconds=t_stop-t_start))
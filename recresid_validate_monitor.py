@@ -0,0 +1,47 @@
+import numpy as np
+from python.monitor import mrecresid_state, mupdate
+from python.recresid import mrecresid
+
+# Residuals appended by `mupdate` to a state from `mrecresid_state` must
+# be those of `mrecresid` on the extended series. Pixels have different
+# numbers of nans, and a dummy regressor that is zero throughout the
+# history keeps every fit rank deficient, so that pixels are still
+# checked when the history ends.
+
+def report(name, ok):
+  print(name, end="")
+  if ok:
+    print("\033[92m PASSED \033[0m")
+  else:
+    print("\033[91m FAILED \033[0m")
+
+N, H, m = 200, 170, 60
+t = np.arange(N)
+X = np.column_stack([np.ones(N), t, np.sin(2*np.pi*t/23),
+                     np.cos(2*np.pi*t/23), (t >= 180).astype(float)])
+k = X.shape[1]
+
+ok_all = True
+for seed in range(3):
+  rng = np.random.default_rng(seed)
+  ys = rng.normal(size=(m, N)) * 10 + t
+  for j in range(m):
+    ys[j, rng.random(N) < rng.uniform(0, 0.5)] = np.nan
+  ns = np.sum(~np.isnan(ys[:, :H]), axis=1)
+
+  _, state = mrecresid_state(X[:H], ys[:, :H])
+  appended = np.array([mupdate(state, X[i], ys[:, i])[0]
+                       for i in range(H, N)]).T
+  full = mrecresid(X, ys)[0]
+  err = 0.0
+  for j in range(m):
+    w = appended[j][~np.isnan(appended[j])]
+    ref = full[j][~np.isnan(full[j])][ns[j]-k:]
+    err = max(err, np.max(np.abs(w - ref) / np.maximum(np.abs(ref), 1e-8),
+                          initial=0.0))
+  ok = err < 1e-8
+  report("seed {}: mupdate == mrecresid (max rel err {:.2e})"
+         .format(seed, err), ok)
+  ok_all = ok_all and ok
+
+print(ok_all)
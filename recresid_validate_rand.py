@@ -4,7 +4,7 @@ from timeit import default_timer as timer
 from glob import glob
 import numpy as np
 from load_dataset import load_fut_data
-from python.recresid import recresid
+from python.recresid import recresid, RecresidWorkspace
 from recresid_pyopencl import recresid_pyopencl
 
 recresid_fut = recresid_pyopencl()
@@ -18,6 +18,7 @@ for fname in glob("./data/*.in"):
   if image.shape[0] > 500:
     print("Large image. Skipping because it would be very slow.")
     continue
+  ws = RecresidWorkspace(*X.shape)
   ok = True
   max_num_checks = 0
   total = len(image)
@@ -28,7 +29,7 @@ for fname in glob("./data/*.in"):
     nan_inds = np.isnan(y)
     ynn = y[~nan_inds]
     Xnn = X[~nan_inds]
-    py_res = recresid(Xnn, ynn)
+    py_res = recresid(Xnn, ynn, ws=ws)
     ocl_res, num_checks = recresid_fut.recresid(Xnn, ynn)
 
     max_num_checks = max(max_num_checks, num_checks)
@@ -51,4 +52,4 @@ for path in glob("./data/*.in"):
   print("... ", path)
   Xt, image = load_fut_data(path)
   name = os.path.basename(path).replace(".in", "")
-  validate(name, 1, Xt.T, image)
+  validate(name, Xt.T, image)
@@ -2,17 +2,16 @@ import os
 from datetime import timedelta
 from timeit import default_timer as timer
 import numpy as np
-import futhark_data
+from load_dataset import load_fut_data
 from recresid_validate import validate
 
 print("\nMAP-DISTRIBUTED PROCEDURE: mrecresid")
 datasets = [
-  ("data/real/sahara.in", "sahara", 4),
-  ("data/real/peru.in", "peru", 4),
-  ("data/real/africa.in", "africa", 32),
+  ("data/real/sahara.in", "sahara"),
+  ("data/real/peru.in", "peru"),
+  ("data/real/africa.in", "africa"),
 ]
-for (path, name, chunks) in datasets:
+for (path, name) in datasets:
   print("\n== Validating {} data set ({}).".format(name, path))
-  with open(path, "rb") as f:
-    Xt, image = futhark_data.load(f)
-  validate(name, chunks, Xt.T, image)
+  Xt, image = load_fut_data(path)
+  validate(name, Xt.T, image)
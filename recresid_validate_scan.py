@@ -0,0 +1,51 @@
+import numpy as np
+from python.instrument import Profile
+from python.recresid import mrecresid, recresid
+
+# `scan=True` fits every prefix from the factorisations of a parallel scan
+# rather than running the recursion. On a trend and harmonic design of a
+# long series, in double and single precision, its residuals must agree
+# with the recursion's, and only the first, nearly collinear prefixes may
+# need dqrdc2's pivoting.
+
+def report(name, ok):
+  print(name, end="")
+  if ok:
+    print("\033[92m PASSED \033[0m")
+  else:
+    print("\033[91m FAILED \033[0m")
+
+N = 600
+t = np.arange(N)
+X = np.column_stack([np.ones(N), t/N] +
+                    [f(2*np.pi*j*t/23) for j in (1, 2)
+                                       for f in (np.sin, np.cos)])
+k = X.shape[1]
+rng = np.random.default_rng(0)
+ys = (X @ rng.normal(size=(k, 8))).T * 100 + rng.normal(size=(8, N)) * 10
+ys[:, rng.random(N) < 0.2] = np.nan
+
+ok_all = True
+for dtype, rtol in ((np.float64, 1e-6), (np.float32, 1e-2)):
+  X_, ys_ = X.astype(dtype), ys.astype(dtype)
+  name = np.dtype(dtype).name
+  p = Profile()
+  rets, fallbacks, Nbar, ns = mrecresid(X_, ys_, scan=True, profile=p)
+  seq = mrecresid(X_, ys_)[0]
+  ok = (p.times["scan"] > 0 and "check" not in p.times
+        and np.all(fallbacks < 2*k) and p.full_refits == np.sum(fallbacks))
+  report("{}: scan used, fallbacks {}".format(name, np.max(fallbacks)), ok)
+  ok_all = ok_all and ok
+  # The first prefixes are too badly conditioned to agree.
+  ok = np.allclose(rets[:, 2*k:], seq[:, 2*k:], rtol=rtol, atol=rtol,
+                   equal_nan=True)
+  report("{}: scan == recursion".format(name), ok)
+  ok_all = ok_all and ok
+
+  nn = ~np.isnan(ys_[0])
+  ok = np.array_equal(recresid(X_[nn], ys_[0, nn], scan=True),
+                      rets[0, :ns[0]-k])
+  report("{}: recresid == mrecresid".format(name), ok)
+  ok_all = ok_all and ok
+
+print(ok_all)
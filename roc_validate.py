@@ -1,30 +1,36 @@
-import os
 from datetime import timedelta
 from timeit import default_timer as timer
 import numpy as np
 from python.roc import history_roc, compute_confidence_brownian
-from mroc_pyopencl import mroc_pyopencl
+from python.cache import ResultCache
+from python.pipeline import mhistory_roc_tiled, tile_size, tiles
 
 alpha = 0.05
 conf = compute_confidence_brownian(alpha)
 
-ocl = mroc_pyopencl()
-
-def validate(name, chunks, X, image, cache_dir=".cache/roc"):
+# The image is split into tiles sized from the memory budget of
+# python/pipeline.py; the opencl results are computed by its pipelined
+# driver and compared tile by tile as they are written, so that the
+# results of the whole image are never held at once.
+def validate(name, X, image, cache_dir=".cache/roc"):
   print("image size", image.shape)
   print("regressor matrix", X.shape)
   k = X.shape[1]
   m, N = image.shape
-  for i, image_chunk in enumerate(np.array_split(image, chunks)):
-    print("~~ chunk {} ({}/{})".format(image_chunk.shape, i+1, chunks))
+  cache = ResultCache(cache_dir)
+  tile = tile_size("mhistory_roc", N, k)
+  chunks = tiles(m, tile)
+
+  def compare(start, stop, ocl_res):
+    c = start // tile
+    image_chunk = image[start:stop]
+    print("~~ chunk {} ({}/{})".format(image_chunk.shape, c+1, len(chunks)))
     print("Computing python results...", end="")
-    if not os.path.isdir(cache_dir):
-      os.makedirs(cache_dir)
-    py_res_file = "{}/{}.chunk{}.npy".format(cache_dir, name, i)
-    if os.path.exists(py_res_file):
-      with open(py_res_file, "rb") as f:
-        py_res = np.load(f)
-      print("loaded from", py_res_file)
+    key = cache.key("history_roc", X, image_chunk, alpha=alpha,
+                    confidence=conf)
+    py_res = cache.get(key)
+    if py_res is not None:
+      print("loaded from cache ({} chunk {})".format(name, c))
     else:
       py_res = np.zeros(image_chunk.shape[0])
       t_start = timer()
@@ -36,15 +42,7 @@ def validate(name, chunks, X, image, cache_dir=".cache/roc"):
         py_res[i] = res
       t_stop = timer()
       print(timedelta(seconds=t_stop-t_start))
-      with open(py_res_file, "wb") as f:
-        np.save(f, py_res)
-
-    print("Computing opencl results...", end="")
-    t_start = timer()
-    ocl_res = ocl.mhistory_roc(alpha, conf, X, image_chunk)
-    t_stop = timer()
-    ocl_res = ocl_res.get()
-    print(timedelta(seconds=t_stop-t_start))
+      cache.put(key, py_res)
 
     check = np.all(py_res == ocl_res)
     print("all equal:", end="")
@@ -61,3 +59,8 @@ def validate(name, chunks, X, image, cache_dir=".cache/roc"):
       print("Python", py_res[inds])
       print("Futhark", ocl_res[inds])
 
+  t_start = timer()
+  mhistory_roc_tiled(X, image, alpha, conf, backend="opencl", tile=tile,
+                     write=compare)
+  t_stop = timer()
+  print("Total time with opencl results:", timedelta(seconds=t_stop-t_start))
@@ -3,7 +3,6 @@ from datetime import timedelta
 from timeit import default_timer as timer
 import numpy as np
 from glob import glob
-import futhark_data
 from load_dataset import load_fut_data
 from roc_validate import validate
 
@@ -14,16 +13,15 @@ for path in glob("./data/*.in"):
   print("... ", path)
   Xt, image = load_fut_data(path)
   name = os.path.basename(path).replace(".in", "")
-  validate(name, 1, Xt.T, image)
+  validate(name, Xt.T, image)
 
 print("Validating real world data sets.")
 datasets = [
-  ("data/real/sahara.in", "sahara", 4),
-  ("data/real/peru.in", "peru", 4),
-  ("data/real/africa.in", "africa", 32),
+  ("data/real/sahara.in", "sahara"),
+  ("data/real/peru.in", "peru"),
+  ("data/real/africa.in", "africa"),
 ]
-for (path, name, chunks) in datasets:
+for (path, name) in datasets:
   print("\n== Validating {} data set ({}).".format(name, path))
-  with open(path, "rb") as f:
-    Xt, image = futhark_data.load(f)
-  validate(name, chunks, Xt.T, image)
+  Xt, image = load_fut_data(path)
+  validate(name, Xt.T, image)
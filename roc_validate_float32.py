@@ -0,0 +1,56 @@
+import numpy as np
+from python.recresid import mrecresid
+from python.roc import history_roc, mhistory_roc, compute_confidence_brownian
+
+# `mhistory_roc` in single precision against `history_roc` per pixel, in
+# single and double precision. The reversed series of a trend and
+# harmonic design start on a badly conditioned fit of the first k
+# observations, where (X'X)^(-1) is lost to rounding in float32; the
+# batched recursion must neither give nan residuals on it nor drift from
+# the per-pixel one.
+
+alpha = 0.05
+conf = compute_confidence_brownian(alpha)
+
+def report(name, ok):
+  print(name, end="")
+  if ok:
+    print("\033[92m PASSED \033[0m")
+  else:
+    print("\033[91m FAILED \033[0m")
+
+N = 200
+t = np.arange(N)
+ok_all = True
+for period in (23, 365):
+  X = np.column_stack([np.ones(N), t] +
+                      [f(2*np.pi*j*t/period) for j in (1, 2)
+                                             for f in (np.sin, np.cos)])
+  for seed in range(3):
+    rng = np.random.default_rng(seed)
+    ys = rng.normal(size=(100, N))*10 + t
+    ys[:, 120:] += 40
+    ys[rng.random(ys.shape) < 0.1] = np.nan
+    X32, ys32 = X.astype(np.float32), ys.astype(np.float32)
+    starts = mhistory_roc(X32, ys32, alpha, conf)
+    starts32, starts64 = [], []
+    for y in ys:
+      nn = ~np.isnan(y)
+      starts32.append(history_roc(X32[nn].T, y[nn].astype(np.float32),
+                                  alpha, conf))
+      starts64.append(history_roc(X[nn].T, y[nn], alpha, conf))
+    same32 = np.mean(starts == np.array(starts32))
+    same64 = np.mean(starts == np.array(starts64))
+    ref64 = np.mean(np.array(starts32) == np.array(starts64))
+    # First residuals of the reversed series, on which `mhistory_roc`
+    # runs the recursion.
+    w = mrecresid(X32[::-1], ys32[:, ::-1])[0]
+    ok = (not np.any(np.isnan(w[:, 0])) and same32 >= 0.9
+          and same64 >= ref64 - 0.05)
+    print("period {} seed {}: equal to float32 {:.2f}, to float64 {:.2f}"
+          " (per pixel float32 {:.2f})".format(period, seed, same32,
+                                              same64, ref64))
+    report("period {} seed {}: float32 mhistory_roc".format(period, seed), ok)
+    ok_all = ok_all and ok
+
+print(ok_all)